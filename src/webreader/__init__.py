@@ -4,27 +4,40 @@
 SoundGecko clone - a web app to convert web pages to an MP3 podcast feed.
 """
 import base64
+import collections
+import contextlib
+import fcntl
+import functools
+import hashlib
 import json
 import os
 
 from argparse import ArgumentParser, ArgumentTypeError
 
 import itertools
-from multiprocessing import Process, Queue
+from multiprocessing import BoundedSemaphore, Process, Queue, Value
+from multiprocessing.connection import wait
 import subprocess as subp
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 from email.mime.text import MIMEText
+from email.utils import format_datetime, parsedate_to_datetime
 import logging
+import random
 import re
+import resource
+import shutil
 from smtplib import SMTP
 import sys
 import tempfile
+import threading
 import traceback
 import socket
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape
+from werkzeug.http import parse_options_header
 from feedgen.feed import FeedGenerator
 import nltk
-from pq import PQ
 import requests
 import flask
 from flask import request
@@ -33,18 +46,19 @@ import ftfy
 from slugify.slugify import slugify
 import sqlalchemy as sa
 from sqlalchemy.engine import create_engine
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm.scoping import scoped_session
 from sqlalchemy.orm.session import sessionmaker
 from flask_cors import cross_origin
+from concurrent.futures import ThreadPoolExecutor
 import time
 import io
+from webreader import metrics, mpeg
+from webreader.metrics import span
 
 __author__ = 'yang'
 
-class TunneledException(Exception):
-  pass
-
 def valid_date(s):
   """
   From <https://stackoverflow.com/questions/25470844/specify-format-for-input-arguments-argparse-python>
@@ -68,9 +82,9 @@ alpha = re.compile(r'[a-z]', re.IGNORECASE)
 newlines = re.compile(r'\n+')
 
 db_session = None
-queue = None
 
 mp3dir = pathlib.Path('~/.webreader/mp3s').expanduser()
+cachedir = pathlib.Path('~/.webreader/cache').expanduser()
 
 Base = declarative_base()
 class Article(Base):
@@ -81,18 +95,205 @@ class Article(Base):
   title = sa.Column(sa.String)
   body = sa.Column(sa.String)
   converted = sa.Column(sa.DateTime)
+  # The article's RSS <item>, rendered when it's converted.  See render_feed_item.
+  feed_item = sa.Column(sa.String)
+  # Size and duration (in seconds) of the MP3 served for the article, and whether it's the
+  # enhanced one, recorded when it's converted.
+  mp3_bytes = sa.Column(sa.Integer)
+  mp3_duration = sa.Column(sa.Float)
+  mp3_enhanced = sa.Column(sa.Boolean)
+  # Seconds spent in each stage of the last conversion, if the converter runs with --record-timings.
+  timings = sa.Column(sa.JSON)
+
+class FeedVersion(Base):
+  """
+  A single row, bumped in every transaction that changes what the feed shows (articles'
+  `converted`, `mp3_bytes` or `feed_item`), so checking whether the cached feed is stale is one
+  row lookup rather than a scan of the articles.
+  """
+  __tablename__ = 'feed_version'
+  id = sa.Column(sa.Integer, primary_key=True)
+  version = sa.Column(sa.Integer, nullable=False)
+
+sa.event.listen(FeedVersion.__table__, 'after_create',
+                sa.DDL('insert into feed_version (id, version) values (1, 0)'))
+
+def bump_feed_version():
+  """Marks the cached feed stale.  Must be called in the transaction that changes the articles."""
+  db_session.query(FeedVersion).update({FeedVersion.version: FeedVersion.version + 1},
+                                       synchronize_session=False)
+
+# Lanes of the task queue, and their priorities (lowest first).  Converters always take
+# interactive work first; enhanced (Wavenet) tasks also have their own concurrency cap.
+LANES = dict(interactive=0, enhanced=1, bulk=2)
+# Estimated cost, in characters, of an article we don't have the text of yet.
+DEFAULT_COST = 20000
+# Within a lane, tasks are due `cost / AGING_CHARS_PER_SEC` seconds after they were enqueued, and
+# the earliest due go first.  So short articles jump ahead of long ones, but only by so much: a
+# book waits at most ~1 hour per 360k characters behind articles submitted after it.
+AGING_CHARS_PER_SEC = 100
+
+class Task(Base):
+  """
+  A queued conversion of an article.  See `claim_task` for the order tasks are taken in.
+  """
+  __tablename__ = 'tasks'
+  id = sa.Column(sa.Integer, primary_key=True)
+  article_id = sa.Column(sa.Integer, nullable=False)
+  enhanced = sa.Column(sa.Boolean, nullable=False, default=False)
+  lane = sa.Column(sa.String, nullable=False)
+  priority = sa.Column(sa.Integer, nullable=False)
+  cost = sa.Column(sa.Integer, nullable=False)
+  # For fairness between sources: the article's host, or '' for pasted text.  See put_many.
+  source = sa.Column(sa.String, nullable=False)
+  turn = sa.Column(sa.Integer, nullable=False)
+  # pending, then leased by a converter, and finally done, or dead after `max_attempts` leases that
+  # ran out (because converters crashed or hung).  See claim_task and release_leases.
+  state = sa.Column(sa.String, nullable=False, default='pending')
+  # Which converter holds the lease, as host:pid, and until when it holds it unless renewed.
+  claimed_by = sa.Column(sa.String)
+  lease_until = sa.Column(sa.DateTime)
+  attempts = sa.Column(sa.Integer, nullable=False, default=0)
+  # Why the last attempt failed, if it did.
+  last_error = sa.Column(sa.String)
+  # In UTC.
+  enqueued_at = sa.Column(sa.DateTime, nullable=False)
+  due_at = sa.Column(sa.DateTime, nullable=False)
+  # When the task was last claimed.
+  dequeued_at = sa.Column(sa.DateTime)
+  __table_args__ = (
+    sa.Index('tasks_pending', priority, turn, due_at,
+             postgresql_where=state == 'pending', sqlite_where=state == 'pending'),
+    sa.Index('tasks_leased', lease_until,
+             postgresql_where=state == 'leased', sqlite_where=state == 'leased'),
+    # For counting them in the metrics.
+    sa.Index('tasks_dead', id, postgresql_where=state == 'dead', sqlite_where=state == 'dead'),
+  )
+
+# How long a converter's claim on a task lasts, in seconds, unless renewed by its heartbeat (which
+# it is every LEASE_SECONDS / 4).  Tasks whose leases run out go back in the queue.
+LEASE_SECONDS = 120
+# Tasks claimed this many times without being finished are given up on.
+max_attempts = 3
+
+class db_now(sa.sql.expression.FunctionElement):
+  """
+  The DB server's current UTC time, plus `seconds`.  Leases are timed by this one clock, so a
+  converter host whose clock runs fast can't take over other hosts' leases early.
+  """
+  type = sa.DateTime()
+  inherit_cache = True
+
+  def __init__(self, seconds=0):
+    super().__init__(sa.literal(seconds, sa.Integer))
+
+@compiles(db_now, 'postgresql')
+def compile_db_now_postgresql(element, compiler, **kw):
+  return "timezone('utc', now()) + %s * interval '1 second'" % compiler.process(element.clauses, **kw)
+
+@compiles(db_now, 'sqlite')
+def compile_db_now_sqlite(element, compiler, **kw):
+  # In the format SQLAlchemy stores DateTimes in, so they compare correctly as strings.
+  return "strftime('%%Y-%%m-%%d %%H:%%M:%%f', 'now', %s || ' seconds')" % compiler.process(element.clauses, **kw)
 
 def swallow(f):
   # noinspection PyBroadException
   try: return f()
   except: return None
 
+def temp_path(path):
+  """A scratch path next to `path`, unique to this thread, to write to before renaming over `path`."""
+  path = pathlib.Path(path)
+  return path.with_name('%s.%s.%s.tmp' % (path.name, os.getpid(), threading.get_ident()))
+
+def atomic_write(path, data):
+  """Writes `data` to `path` via a rename, so readers never see a partially written file."""
+  path = pathlib.Path(path)
+  tmp = temp_path(path)
+  tmp.write_bytes(data if isinstance(data, bytes) else data.encode('utf8'))
+  os.replace(tmp, path)
+
 def extract(html):
   import trafilatura
-  extracted = trafilatura.extract(html, include_comments=False)
-  doc = trafilatura.extract_metadata(html)
+  from trafilatura.utils import normalize_unicode
+  # Parses the HTML once for both the metadata and the text, unlike separate calls to
+  # trafilatura.extract and trafilatura.extract_metadata.
+  doc = trafilatura.bare_extraction(html, include_comments=False)
   # doc can be None if we're looking at non-HTML plain text file
-  return doc.title if doc else None, extracted
+  if doc is None:
+    return None, None
+  return doc['title'], normalize_unicode(doc['text'])
+
+class PageCache(object):
+  """
+  Persistent cache of what we extracted from each URL.  Entries checked within the last `fresh`
+  seconds are used as-is; older ones are revalidated with a conditional GET.  Concurrent lookups
+  of the same URL, from any thread or process, wait for the first one rather than fetching again.
+  """
+  def __init__(self, root, fresh=600, max_age=7 * 86400):
+    self.root = pathlib.Path(root)
+    self.fresh = fresh
+    self.max_age = max_age
+    self.hits = 0
+    self.revalidated = 0
+    self.misses = 0
+
+  def path(self, url):
+    key = hashlib.sha256(url.encode('utf8')).hexdigest()
+    return self.root / key[:2] / ('%s.json' % key)
+
+  @contextlib.contextmanager
+  def locked(self, path):
+    # flock locks belong to the open file, so this excludes other threads as well as processes.
+    with open(path.with_suffix('.lock'), 'a') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def get(self, url, load):
+    """
+    :param load: Called with the conditional request headers and content digest of our cached copy
+      (if any).  Returns None if the page wasn't modified, else a dict with `title`, `text` and the
+      response's `etag`, `last_modified` and content `digest`.
+    :return: (title, text)
+    """
+    path = self.path(url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with self.locked(path):
+      entry = swallow(lambda: json.loads(path.read_text()))
+      if entry and time.time() - entry['checked'] < self.fresh:
+        self.hits += 1
+        return entry['title'], entry['text']
+      headers = {}
+      if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+      if entry and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+      loaded = load(headers, entry and entry.get('digest'))
+      if loaded is None and entry:
+        self.revalidated += 1
+      else:
+        self.misses += 1
+        entry = dict(loaded, url=url)
+      entry['checked'] = time.time()
+      atomic_write(path, json.dumps(entry))
+      return entry['title'], entry['text']
+
+  def prune(self):
+    cutoff = time.time() - self.max_age
+    # Lock files stay: deleting one while a lookup holds it would let the next lookup lock a new
+    # file alongside it.
+    for f in self.root.glob('*/*.json'):
+      st = swallow(f.stat)
+      if st and st.st_mtime < cutoff:
+        swallow(f.unlink)
+
+  def stats(self):
+    return dict(hits=self.hits, revalidated=self.revalidated, misses=self.misses)
+
+page_cache = None
 
 @app.route('/api/v1/enqueue', methods=['GET','POST'])
 @cross_origin()
@@ -107,37 +308,279 @@ def enqueue():
     article = Article(url=url, body=body, created=datetime.now())
     db_session.add(article)
     db_session.flush()
-  queue.put(dict(article_id=article.id))
+    put_many([task_for(article.id, url, body and len(body), 'interactive')])
   return flask.jsonify(done=True)
 
+# The feed lists at most this many of the latest articles.  See retain for what happens to the rest.
+FEED_MAX_ITEMS = 99
+# Feed descriptions are a bounded prefix of the body; the MP3 is the real content.
+FEED_DESCRIPTION_CHARS = 4000
+# Placeholders for per-request values in rendered feed items.  Text content is always escaped, so
+# these can't occur in anything that came from an article.
+BASE_URL_MARK = '<webreader-base-url/>'
+KEY_MARK = '<webreader-key/>'
+invalid_xml = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def xml_text(s, attr=False):
+  return escape(invalid_xml.sub('', s), {'"': '&quot;'} if attr else {})
+
+def format_duration(seconds):
+  seconds = int(round(seconds))
+  return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def render_feed_item(article_id, url, created, title, body, mp3_bytes=None, mp3_duration=None):
+  """
+  Renders an article's RSS <item> with placeholders for the base URL and key.  `body` only needs to
+  be the first FEED_DESCRIPTION_CHARS characters of the article body.
+  """
+  mp3_url = '%s/mp3/%s?key=%s' % (BASE_URL_MARK, article_id, KEY_MARK)
+  return ''.join([
+    '<item>',
+    '<title>%s</title>' % xml_text(ftfy.fix_text(title or (body or '(empty)')[:100])),
+    '<link>%s</link>' % xml_text(url) if url else '',
+    '<description>%s</description>' % xml_text(ftfy.fix_text(trunc_txt(body or '(empty)', FEED_DESCRIPTION_CHARS))),
+    '<guid isPermaLink="false">%s</guid>' % mp3_url,
+    '<enclosure url="%s" length="%d" type="audio/mpeg"/>' % (mp3_url, mp3_bytes or 0),
+    '<pubDate>%s</pubDate>' % format_datetime(created.replace(tzinfo=pytz.UTC)),
+    '<itunes:duration>%s</itunes:duration>' % format_duration(mp3_duration) if mp3_duration else '',
+    '</item>',
+  ])
+
+# (limit, base URL, key) -> (last converted time, rendered feed, ETag)
+feed_cache = {}
+
+def task_for(article_id, url, cost, lane, enhanced=False):
+  """The row for a task converting an article, with `cost` its body length if we have the body."""
+  now = datetime.utcnow()
+  cost = cost or DEFAULT_COST
+  return dict(article_id=article_id, enhanced=enhanced, lane=lane, priority=LANES[lane], cost=cost,
+              source=urlsplit(url).netloc if url else '', enqueued_at=now,
+              due_at=now + timedelta(seconds=cost / AGING_CHARS_PER_SEC))
+
+def put_many(tasks):
+  """
+  Enqueues several tasks (see `task_for`) with a single INSERT, in the current transaction.  Each
+  task's turn comes after those of its source's pending tasks in its lane, but no earlier than the
+  lane's current turn, so a new source doesn't wait behind another's backlog.
+  """
+  if not tasks:
+    return
+  pending = db_session.query(Task).filter(Task.state == 'pending')
+  current = dict(pending.with_entities(Task.lane, sa.func.min(Task.turn)).group_by(Task.lane))
+  last = {
+    (lane, source): turn
+    for lane, source, turn in pending
+      .with_entities(Task.lane, Task.source, sa.func.max(Task.turn))
+      .filter(Task.source.in_({task['source'] for task in tasks}))
+      .group_by(Task.lane, Task.source)
+  }
+  rows = []
+  for task in tasks:
+    key = task['lane'], task['source']
+    last[key] = max(last.get(key, -1) + 1, current.get(task['lane'], 0))
+    rows.append(dict(task, turn=last[key]))
+  db_session.execute(sa.insert(Task).values(rows))
+
+def claim_task(lanes, owner):
+  """
+  Leases the next task from any of `lanes` to `owner`, or returns None if there are none.  Tasks are
+  taken from the highest priority lane first, then in order of turn, so sources within a lane take
+  turns.  A source's turn goes to whichever of its tasks is due first.  Concurrent claims skip each
+  other's locked rows rather than waiting.  Must be called in a transaction, which should be kept
+  short: the lease, not the transaction, is what keeps other converters off the task.
+  """
+  pending = db_session.query(Task)\
+    .filter(Task.state == 'pending', Task.lane.in_(lanes))\
+    .with_for_update(skip_locked=True)
+  slot = pending.order_by(Task.priority, Task.turn, Task.due_at, Task.id).first()
+  if slot is None:
+    return None
+  task = pending.filter(Task.lane == slot.lane, Task.source == slot.source)\
+    .order_by(Task.due_at, Task.id).first()
+  if task.id != slot.id:
+    task.turn, slot.turn = slot.turn, task.turn
+  task.dequeued_at = datetime.utcnow()
+  task.state = 'leased'
+  task.claimed_by = owner
+  task.lease_until = db_now(LEASE_SECONDS)
+  task.attempts += 1
+  return task
+
+def renew_lease(task_id, owner):
+  """Extends `owner`'s lease on a task.  Returns False if it no longer holds the lease."""
+  with db_session.begin():
+    return db_session.query(Task)\
+      .filter(Task.id == task_id, Task.state == 'leased', Task.claimed_by == owner)\
+      .update(dict(lease_until=db_now(LEASE_SECONDS)), synchronize_session=False) > 0
+
+def finish_task(task_id, owner, error=None):
+  """
+  Marks a task leased by `owner` done, with the `error` it failed with, if any (conversion errors
+  aren't retried).  Must be called in a transaction.
+  """
+  finished = db_session.query(Task)\
+    .filter(Task.id == task_id, Task.state == 'leased', Task.claimed_by == owner)\
+    .update(dict(state='done', lease_until=None, last_error=error), synchronize_session=False)
+  if not finished:
+    log.warning('finished task %s after losing its lease', task_id)
+
+def release_leases(leased, error):
+  """
+  Puts the leased tasks matching the filter `leased` back in the queue, or once they've been
+  attempted `max_attempts` times, marks them dead.  Must be called in a transaction.  Returns the
+  dead tasks.
+  """
+  dead = []
+  for task in db_session.query(Task).filter(Task.state == 'leased', leased).with_for_update(skip_locked=True):
+    task.state = 'dead' if task.attempts >= max_attempts else 'pending'
+    task.claimed_by = task.lease_until = None
+    task.last_error = error
+    if task.state == 'dead':
+      log.error('giving up on task %s for article %s after %s attempts: %s',
+                task.id, task.article_id, task.attempts, error)
+      dead.append(task)
+    else:
+      log.warning('re-queueing task %s for article %s: %s', task.id, task.article_id, error)
+    tasks_released.inc(state=task.state)
+  return dead
+
+class LeaseLost(Exception):
+  pass
+
+class Heartbeat(object):
+  """
+  Renews `owner`'s lease on a task from a background thread while in use, so other converters only
+  take the task over if this one dies or hangs.  If the lease is lost anyway (e.g. after a long
+  stall), `check` raises LeaseLost, so the work can stop before it clashes with the new owner's.
+  `attempt` tells this lease apart from the task's earlier and later ones (see convert_text).
+  """
+  def __init__(self, task_id, owner, attempt):
+    self.task_id = task_id
+    self.owner = owner
+    self.attempt = attempt
+    self.stopped = threading.Event()
+    self.lost = threading.Event()
+    self.thread = threading.Thread(target=self.run, name='heartbeat', daemon=True)
+
+  def run(self):
+    while not self.stopped.wait(LEASE_SECONDS / 4):
+      try:
+        if not renew_lease(self.task_id, self.owner):
+          log.warning('lost the lease on task %s', self.task_id)
+          self.lost.set()
+          return
+      except Exception:
+        # Try again next time; the lease has a few more beats' worth of slack.
+        log.exception('error renewing the lease on task %s', self.task_id)
+
+  def check(self):
+    if self.lost.is_set():
+      raise LeaseLost('lost the lease on task %s' % self.task_id)
+
+  def verify(self):
+    """Like check, but asks the DB (renewing the lease) rather than going by the last beat."""
+    if not renew_lease(self.task_id, self.owner):
+      self.lost.set()
+    self.check()
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stopped.set()
+    self.thread.join()
+
+@app.route('/api/v1/enqueue/batch', methods=['POST'])
+@cross_origin()
+def enqueue_batch():
+  """
+  Enqueues many articles at once, in the bulk lane.  The request body is either a JSON array or
+  newline-delimited JSON objects, each with a `url` and/or `body`.  Items with the same URL are only
+  enqueued once (keeping the longest body).  Responds with the article ID for each item, in order.
+  """
+  check_secret()
+  if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+    items = [json.loads(line) for line in request.stream if line.strip()]
+  else:
+    items = request.get_json()
+  rows = []
+  row_by_url = {}
+  item_rows = []
+  for item in items:
+    url = item.get('url')
+    body = item.get('body') or None
+    if (url or '').strip() == '' and (body or '').strip() == '':
+      raise Exception('must provide at least url or body')
+    if url and url in row_by_url:
+      row = rows[row_by_url[url]]
+      if len(body or '') > len(row['body'] or ''):
+        row['body'] = body
+    else:
+      if url:
+        row_by_url[url] = len(rows)
+      rows.append(dict(url=url, body=body, created=datetime.now()))
+    item_rows.append(row_by_url[url] if url else len(rows) - 1)
+  ids = []
+  if rows:
+    md5 = lambda body: body and hashlib.md5(body.encode('utf8')).hexdigest()
+    with db_session.begin():
+      # RETURNING needn't follow the order of VALUES, so match the rows up by what was inserted.
+      # Rows that match are identical, so it doesn't matter which of them gets which ID.
+      inserted = collections.defaultdict(list)
+      for id, url, body_md5 in db_session.execute(
+          sa.insert(Article).values(rows).returning(Article.id, Article.url, sa.func.md5(Article.body))):
+        inserted[url, body_md5].append(id)
+      ids = [inserted[row['url'], md5(row['body'])].pop() for row in rows]
+      put_many([task_for(id, row['url'], row['body'] and len(row['body']), 'bulk')
+                for id, row in zip(ids, rows)])
+  return flask.jsonify(done=True, ids=[ids[i] for i in item_rows])
+
 @app.route('/feed')
 def feed():
   check_secret()
-  limit = min(int(request.args.get('limit', 99)), 99)
-  fg = FeedGenerator()
-  fg.load_extension('podcast')
+  limit = min(int(request.args.get('limit', FEED_MAX_ITEMS)), FEED_MAX_ITEMS)
   base_url = app.config['base_url']
-  fg.id('%s/feed' % base_url)
-  fg.title('AudioLizard podcast feed')
-  fg.description('blah')
-  fg.link(href=('%s' % base_url), rel='alternate')
-  fg.link(href=('%s/feed?key=%s' % (base_url, app.config.get('secret'))), rel='self')
-  fg.language('en')
+  key = app.config.get('secret')
   with db_session.begin():
-    articles = db_session.query(Article)\
-      .filter(Article.converted != None)\
-      .order_by(Article.created.desc())\
-      .limit(limit)
-    for article in articles:
-      fe = fg.add_entry()
-      mp3_url = '%s/mp3/%s?key=%s' % (base_url, article.id, app.config.get('secret'))
-      fe.id(mp3_url)
-      fe.title(ftfy.fix_text(article.title or (article.body or '(empty)')[:100]))
-      fe.description(ftfy.fix_text(article.body or '(empty)'))
-      fe.link(href=article.url)
-      fe.pubDate(article.created.replace(tzinfo=pytz.UTC))
-      fe.enclosure(mp3_url, 0, 'audio/mpeg')
-    return flask.Response(fg.rss_str(pretty=True), mimetype='application/rss+xml')
+    # Bumped by every change to the feed's articles, so it's all we need to check whether the
+    # cached feed is stale.
+    version = db_session.query(FeedVersion.version).scalar()
+    cache_key = (limit, base_url, key)
+    cached = feed_cache.get(cache_key)
+    if cached is None or cached[0] != version:
+      last_converted = db_session.query(sa.func.max(Article.converted)).scalar()
+      # Articles converted before feed items were pre-rendered get rendered here.
+      rows = db_session.query(
+          Article.id, Article.feed_item, Article.url, Article.created, Article.title,
+          sa.case((Article.feed_item.is_(None), sa.func.substr(Article.body, 1, FEED_DESCRIPTION_CHARS))),
+          Article.mp3_bytes, Article.mp3_duration,
+        )\
+        .filter(Article.converted != None)\
+        .order_by(Article.created.desc())\
+        .limit(limit)
+      items = ''.join(
+        feed_item or render_feed_item(article_id, url, created, title, body, mp3_bytes, mp3_duration)
+        for article_id, feed_item, url, created, title, body, mp3_bytes, mp3_duration in rows
+      ).replace(BASE_URL_MARK, xml_text(base_url, True)).replace(KEY_MARK, xml_text(str(key), True))
+      fg = FeedGenerator()
+      fg.load_extension('podcast')
+      fg.id('%s/feed' % base_url)
+      fg.title('AudioLizard podcast feed')
+      fg.description('blah')
+      fg.link(href=('%s' % base_url), rel='alternate')
+      fg.link(href=('%s/feed?key=%s' % (base_url, key)), rel='self')
+      fg.language('en')
+      if last_converted:
+        fg.lastBuildDate(last_converted.replace(tzinfo=pytz.UTC))
+      head, tail = fg.rss_str(pretty=False).rsplit(b'</channel>', 1)
+      body = head + items.encode('utf8') + b'</channel>' + tail
+      cached = feed_cache[cache_key] = (version, body, hashlib.sha1(body).hexdigest(), last_converted)
+  resp = flask.Response(cached[1], mimetype='application/rss+xml')
+  resp.set_etag(cached[2])
+  if cached[3]:
+    resp.last_modified = cached[3].replace(tzinfo=pytz.UTC)
+  return resp.make_conditional(request)
 
 class UnauthException(Exception):
   status_code = 401
@@ -166,20 +609,39 @@ def check_secret(key = None):
                                                                            request.args.get('secret')):
     raise UnauthException('secret does not match!')
 
+@functools.lru_cache(maxsize=4096)
+def mp3_filename(article_id, mtime):
+  """
+  The download filename for an article.  `mtime` is the MP3's modification time, which changes
+  whenever the article is (re)converted and thus whenever its title might have changed.
+  """
+  with db_session.begin():
+    # The slug is capped at 256 chars, so there's no need to pull the whole body.
+    title, body = db_session.query(Article.title, sa.func.substr(Article.body, 1, 2048))\
+      .filter(Article.id == article_id).one()
+  slug = slugify(title or body or '', max_length=256,
+                 word_boundary=True, save_order=True)
+  return '%s - %s.mp3' % (article_id, slug)
+
 @app.route('/mp3/<int:article_id>')
 def mp3(article_id):
   check_secret()
-  with db_session.begin():
-    article = db_session.query(Article).get(article_id)
-    slug = slugify(article.title or article.body, max_length=256,
-                   word_boundary=True, save_order=True)
-    filename = '%s - %s.mp3' % (article_id, slug)
-    best_path = enhanced_mp3_path(article)
-    if not best_path.exists():
-      best_path = mp3path(article)
-    with open(best_path, 'rb') as f:
-      return flask.Response(f.read(), mimetype='audio/mpeg',
-          headers={"Content-Disposition": "attachment; filename=%s" % filename})
+  # The paths only depend on the ID, so there's no need to hit the DB for the article.
+  article = Article(id=article_id)
+  for best_path in [enhanced_mp3_path(article), mp3path(article)]:
+    st = swallow(best_path.stat)
+    if st is not None:
+      break
+  else:
+    flask.abort(404)
+  # send_file streams from disk (with sendfile where the server supports it) and handles Range
+  # requests, ETag/Last-Modified, and conditional 304s.
+  resp = flask.send_file(best_path, mimetype='audio/mpeg', as_attachment=True,
+                         download_name=mp3_filename(article_id, st.st_mtime_ns),
+                         conditional=True, etag=True, last_modified=st.st_mtime)
+  # Advertise seeking support up front, so players don't have to probe for it.
+  resp.headers['Accept-Ranges'] = 'bytes'
+  return resp
 
 @app.route('/mp3/<int:article_id>/enhance')
 def enhance_get(article_id):
@@ -195,76 +657,502 @@ def enhance_post(article_id):
   check_secret()
   with db_session.begin():
     article = db_session.query(Article).get(article_id)
-    queue.put(dict(article_id=article.id, enhanced=True))
+    put_many([task_for(article.id, article.url, article.body and len(article.body), 'enhanced', True)])
   return 'Done!'
 
-def convert(url, outpath, enhanced=False):
-  resp = get_with_retries(url, verify=False, headers={'user-agent': UA})
+web_request_seconds = metrics.registry.histogram(
+  'webreader_web_request_seconds', 'Time to handle web requests', ['endpoint', 'method', 'status'])
+queue_depth = metrics.registry.gauge(
+  'webreader_queue_depth', 'Tasks waiting to be converted', ['lane'])
+queue_age = metrics.registry.gauge(
+  'webreader_queue_oldest_task_age_seconds', 'How long the oldest waiting task has been queued', ['lane'])
+dead_tasks = metrics.registry.gauge(
+  'webreader_dead_tasks', 'Tasks given up on after too many attempts')
+tasks_released = metrics.registry.counter(
+  'webreader_tasks_released_total', 'Leased tasks put back in the queue or given up on', ['state'])
+
+@app.before_request
+def start_request_timer():
+  flask.g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_latency(resp):
+  start = flask.g.get('request_start')
+  if start is not None:
+    web_request_seconds.observe(time.perf_counter() - start,
+                                endpoint=request.url_rule.rule if request.url_rule else '(unmatched)',
+                                method=request.method, status=resp.status_code)
+  return resp
+
+def update_queue_metrics():
+  with db_session.begin():
+    pending = {
+      lane: (depth, oldest)
+      for lane, depth, oldest in db_session.query(Task.lane, sa.func.count(), sa.func.min(Task.enqueued_at))
+        .filter(Task.state == 'pending')
+        .group_by(Task.lane)
+    }
+    dead = db_session.query(sa.func.count()).filter(Task.state == 'dead').scalar()
+  dead_tasks.set(dead)
+  now = datetime.utcnow()
+  for lane in LANES:
+    depth, oldest = pending.get(lane, (0, None))
+    queue_depth.set(depth, lane=lane)
+    queue_age.set((now - oldest).total_seconds() if oldest else 0, lane=lane)
+
+# Where gunicorn workers publish their metrics for each other, if there are several (see run_webserver).
+metrics_dir = None
+
+@app.route('/metrics')
+def metrics_view():
+  check_secret()
+  update_queue_metrics()
+  snapshot = metrics.registry.snapshot()
+  if metrics_dir:
+    snapshot = metrics.merge(metrics.gather(metrics_dir, exclude=os.getpid()), snapshot)
+  return flask.Response(metrics.render(snapshot), content_type=metrics.CONTENT_TYPE)
+
+# Content types we convert: HTML via extraction, and text as is.
+HTML_TYPES = {'text/html', 'application/xhtml+xml'}
+TEXT_TYPES = {'text/plain', 'text/markdown'}
+# Limits on fetching a page: its size (after decompression), and the seconds to fetch it in.
+max_page_bytes = 10 * 2 ** 20
+fetch_deadline = 60
+meta_charset = re.compile(rb'''<meta[^>]+charset=["']?([\w.:-]+)''', re.IGNORECASE)
+html_start = re.compile(rb'<(!doctype html|html|head|body|title|p|div)\b', re.IGNORECASE)
+
+class PageRejected(Exception):
+  pass
 
-  log.info('gotten, extracting')
-  raw_title, raw_text = extract(resp.text)
+def sniff_type(head):
+  """Guesses the content type of a page served without one from its first bytes."""
+  if b'\0' in head or head.startswith(b'%PDF'):
+    return 'application/octet-stream'
+  return 'text/html' if html_start.search(head[:1024]) else 'text/plain'
+
+def decode_page(data, mimetype, charset=None):
+  """Decodes a page with the charset from its headers or, for HTML, its <meta> tag, else UTF-8."""
+  if not charset and mimetype in HTML_TYPES:
+    match = meta_charset.search(data[:4096])
+    charset = match and match.group(1).decode('ascii')
+  for encoding in filter(None, [charset, 'utf-8']):
+    try:
+      return data.decode(encoding)
+    except (LookupError, UnicodeDecodeError):
+      pass
+  return data.decode('cp1252', errors='replace')
+
+def abort_response(resp):
+  """Closes a streamed response from another thread, unblocking any read in progress."""
+  # Just closing the file object doesn't wake up a thread blocked reading from the socket.
+  sock = swallow(lambda: resp.raw._connection.sock) or swallow(lambda: resp.raw._fp.fp.raw._sock)
+  if sock is not None:
+    swallow(lambda: sock.shutdown(socket.SHUT_RDWR))
+  swallow(resp.close)
+
+def fetch_page(url, headers):
+  """
+  Streams a page, returning the response, its content type, charset and body, or None if the server
+  says it wasn't modified.  Raises PageRejected as soon as it can tell the page is neither HTML nor
+  text, is over `max_page_bytes`, or won't be done within `fetch_deadline` seconds, counting
+  connecting and retrying.
+  """
+  deadline = time.monotonic() + fetch_deadline
+  late = PageRejected('%s took over %ss to fetch' % (url, fetch_deadline))
+  try:
+    resp = get_with_retries(url, verify=False, stream=True, headers=headers, timeout=(10, 30),
+                            deadline=deadline)
+  except requests.RequestException as ex:
+    if time.monotonic() >= deadline:
+      raise late from ex
+    raise
+  # Servers can trickle out a body slowly enough to never trip the read timeout.
+  expired = threading.Event()
+  def expire():
+    expired.set()
+    abort_response(resp)
+  watchdog = threading.Timer(max(0, deadline - time.monotonic()), expire)
+  watchdog.daemon = True
+  watchdog.start()
+  try:
+    with contextlib.closing(resp):
+      page = read_page(url, resp)
+  except Exception as ex:
+    if expired.is_set():
+      raise late from ex
+    raise
+  finally:
+    watchdog.cancel()
+  # Bodies delimited by the connection closing look complete when cut off.
+  if expired.is_set():
+    raise late
+  return page
+
+def read_page(url, resp):
+  """The body of a streamed response to fetch_page, checking its type and size as it arrives."""
+  if resp.status_code == 304:
+    return None
+  mimetype, options = parse_options_header(resp.headers.get('Content-Type', ''))
+  mimetype = mimetype or None
+  if mimetype is not None and mimetype not in HTML_TYPES | TEXT_TYPES:
+    raise PageRejected('%s is %s, not HTML or text' % (url, mimetype))
+  length = swallow(lambda: int(resp.headers['Content-Length']))
+  if length is not None and length > max_page_bytes:
+    raise PageRejected('%s is %s bytes, over the limit of %s' % (url, length, max_page_bytes))
+  chunks = []
+  size = 0
+  for chunk in resp.iter_content(64 * 1024):
+    # Only pages served without a type are sniffed, from their first chunk.
+    if mimetype is None:
+      mimetype = sniff_type(chunk)
+      if mimetype not in HTML_TYPES | TEXT_TYPES:
+        raise PageRejected('%s looks like %s, not HTML or text' % (url, mimetype))
+    size += len(chunk)
+    if size > max_page_bytes:
+      raise PageRejected('%s is over the limit of %s bytes' % (url, max_page_bytes))
+    chunks.append(chunk)
+  return resp, mimetype or 'text/plain', options.get('charset'), b''.join(chunks)
+
+def fetch_and_extract(url, headers, digest=None):
+  """
+  Fetches and extracts a page for PageCache.get.  Returns None if the server says the page wasn't
+  modified or its content is identical to `digest`.  Text pages are used as is.
+  """
+  with span('fetch'):
+    page = fetch_page(url, dict(headers, **{'user-agent': UA}))
+  if page is None:
+    return None
+  resp, mimetype, charset, data = page
+  new_digest = hashlib.sha256(data).hexdigest()
+  if new_digest == digest:
+    return None
+  text = decode_page(data, mimetype, charset)
+  if mimetype in TEXT_TYPES:
+    log.info('gotten plain text')
+    title = None
+  else:
+    log.info('gotten, extracting')
+    with span('extract'):
+      title, text = extract(text)
+  return dict(title=title, text=text, etag=resp.headers.get('ETag'),
+              last_modified=resp.headers.get('Last-Modified'), digest=new_digest)
+
+def convert(url, outpath, enhanced=False, heartbeat=None):
+  if page_cache:
+    raw_title, raw_text = page_cache.get(url, lambda headers, digest: fetch_and_extract(url, headers, digest))
+    log.info('page cache stats: %r', page_cache.stats())
+  else:
+    loaded = fetch_and_extract(url, {})
+    raw_title, raw_text = loaded['title'], loaded['text']
+  if raw_text is None:
+    raise Exception('could not extract any text from %s' % url)
   log.info('ftfy')
-  text = ftfy.fix_text(raw_text)
-  title = ftfy.fix_text(raw_title) if len(raw_title.strip()) > 0 else ''
+  with span('ftfy'):
+    text = ftfy.fix_text(raw_text)
+    title = ftfy.fix_text(raw_title) if raw_title and len(raw_title.strip()) > 0 else ''
 
-  return convert_text(title, text, outpath, enhanced)
+  return convert_text(title, text, outpath, enhanced, heartbeat)
 
 splitters = [
     re.compile(r'[:;]| -+ |\.{2,}|--+|—'),
     re.compile(r'[,]'),
 ]
 
-# API supports max 5000 bytes per request.
-def segments(sents, maxbytes=5000):
-  i = 0
-  while True:
-    curseg = []
-    count = 0
-    while i < len(sents):
-      sent = sents[i]
-      padding = 5
-      if len(curseg) > 0 and count + padding + len(sent.encode('utf8')) >= maxbytes:
-        break
-      curseg.append(sent)
-      count += padding + len(sent.encode('utf8'))
-      i += 1
-    if len(curseg) > 0:
-      # Sentences better be split with ". " or ".\n" - if you split with two spaces ".  "
-      # then the API doesn't pause for very long in between sentences, for some reason!
-      yield '.\n'.join(curseg)
-    else:
-      break
+whitespace = re.compile(r'\s+')
 
-def convert_text(title, text, outpath, enhanced=False):
-  log.info('converting %s', title)
-  sent_detector = nltk.data.load('tokenizers/punkt/english.pickle')
-
-  log.info('sentence segmentation')
-  paragraphs = newlines.split(text.strip())
-  sents = [
-    sent
-    for par in [title] + paragraphs
-    if par and alpha.search(par)
-    for sent in sent_detector.tokenize(par.strip())
-    if alpha.search(sent)
-  ]
+def utf8_len(s):
+  return len(s.encode('utf8'))
+
+def split_sentence(sent, maxbytes, size=utf8_len, levels=splitters + [whitespace]):
+  """
+  Splits `sent` into as few pieces as it can of at most `maxbytes` bytes as measured by `size`,
+  cutting after the matches of the first of `levels` that it can, then the next, and so on, and
+  failing all those, at the last character boundary that fits.  `size` must be additive (apart
+  from a constant overhead), like UTF-8 length or escaped length plus markup.
 
-  log.info('grouping into chunks')
-  segs = list(segments(sents))
+  :raise ValueError: If `maxbytes` is too small to hold some character of `sent` (or anything at
+  all) on its own.
+  """
+  if size('') > maxbytes:
+    raise ValueError('%s bytes is too few to hold even an empty piece' % maxbytes)
+  if len(sent) <= maxbytes and size(sent) <= maxbytes:
+    return [sent]
+  if not levels:
+    pieces = []
+    while len(sent) > maxbytes or size(sent) > maxbytes:
+      # Binary search for the longest prefix that fits; it can't be longer than maxbytes chars.
+      lo, hi = 1, maxbytes
+      while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if size(sent[:mid]) <= maxbytes:
+          lo = mid
+        else:
+          hi = mid - 1
+      if lo == 1 and size(sent[:1]) > maxbytes:
+        raise ValueError('%r takes more than %s bytes on its own' % (sent[0], maxbytes))
+      pieces.append(sent[:lo])
+      sent = sent[lo:]
+    return pieces + [sent]
+  overhead = size('')
+  ends = [m.end() for m in levels[0].finditer(sent)]
+  pieces = []
+  piece, piece_size = [], overhead
+  for start, end in zip([0] + ends, ends + [len(sent)]):
+    part = sent[start:end]
+    part_size = size(part) - overhead
+    # Merge parts back together while they fit, and split the ones that don't fit on their own.
+    if piece_size + part_size > maxbytes:
+      pieces.append(''.join(piece))
+      piece, piece_size = [], overhead
+      if overhead + part_size > maxbytes:
+        pieces.extend(split_sentence(part, maxbytes, size, levels[1:]))
+        continue
+    piece.append(part)
+    piece_size += part_size
+  pieces.append(''.join(piece))
+  return [piece.strip() for piece in pieces if piece.strip()]
+
+# Bump whenever segments() would pack the same sentences differently, so interrupted conversions
+# start over rather than resume with misaligned segments.
+SEGMENTS_VERSION = 2
+
+# The API takes at most 5000 bytes per request.
+def segments(sents, maxbytes=5000, ssml=False):
+  """
+  Packs sentences into requests of at most `maxbytes` bytes, in order, filling each before starting
+  the next (which makes for the fewest requests).  Sentences too long to fit in a request of their
+  own are split with split_sentence.  With `ssml`, requests are SSML, and each after the first
+  starts with the pause that would otherwise have to be joined in between them.
 
-  auth_key = subp.check_output('gcloud auth application-default print-access-token'.split()).strip().decode('utf8')
+  :raise ValueError: If `maxbytes` is too small to hold the markup plus any one character.
+  """
+  if ssml:
+    head, tail, sep = '<speak>', '</speak>', ''
+    first_head = head
+    head += '<break time="500ms"/>'
+    wrap = lambda sent: '<s>%s</s>' % xml_text(sent)
+  else:
+    # Sentences better be split with ". " or ".\n" - if you split with two spaces ".  "
+    # then the API doesn't pause for very long in between sentences, for some reason!
+    head = first_head = tail = ''
+    sep = '.\n'
+    wrap = lambda sent: sent
+  # Split sentences to fit any request, but fill the first (which has no pause) to its own limit.
+  budget = maxbytes - utf8_len(head) - utf8_len(tail)
+  size = lambda sent: utf8_len(wrap(sent))
+  if size('') > budget:
+    raise ValueError('%s bytes is too few to hold even an empty request' % maxbytes)
+  curseg = []
+  count = 0
+  first = True
+  for sent in sents:
+    for piece in split_sentence(sent, budget, size):
+      piece_size = size(piece)
+      room = maxbytes - utf8_len(first_head if first else head) - utf8_len(tail)
+      if curseg and count + len(sep) + piece_size > room:
+        yield (first_head if first else head) + sep.join(map(wrap, curseg)) + tail
+        first = False
+        curseg = []
+        count = 0
+      count += piece_size + (len(sep) if curseg else 0)
+      curseg.append(piece)
+  if curseg:
+    yield (first_head if first else head) + sep.join(map(wrap, curseg)) + tail
+
+class TokenBucket(object):
+  """
+  Thread-safe token bucket allowing `rate` acquisitions per second on average, with bursts of up
+  to `burst`.  A rate of None disables limiting.
+  """
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self.burst = burst or max(1, rate or 1)
+    self.tokens = self.burst
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    if not self.rate: return
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+class SegmentCache(object):
+  """
+  Persistent content-addressed store of synthesized segment audio, keyed by a hash of the full
+  synthesis request (text, voice and audio config).  Once the cache grows past `max_bytes`, the
+  least recently used entries are evicted.  Safe to share between threads and processes.
+  """
+  def __init__(self, root, max_bytes=2 * 1024 ** 3):
+    self.root = pathlib.Path(root)
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.size = None
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def key(request):
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf8')).hexdigest()
+
+  def path(self, key):
+    return self.root / key[:2] / ('%s.mp3' % key)
+
+  def get(self, key):
+    path = self.path(key)
+    try:
+      data = path.read_bytes()
+      # mtime doubles as the last-used time for LRU eviction.
+      os.utime(path)
+    except FileNotFoundError:
+      with self.lock: self.misses += 1
+      return None
+    with self.lock: self.hits += 1
+    return data
+
+  def put(self, key, data):
+    path = self.path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(path, data)
+    with self.lock:
+      if self.size is None:
+        self.size = sum(f.stat().st_size for f in self.root.glob('*/*.mp3'))
+      else:
+        self.size += len(data)
+      if self.size > self.max_bytes:
+        self.evict()
+
+  def evict(self):
+    # Other processes may be writing to the same directory, so rescan rather than trusting
+    # our own running total.  Evict down to 90% to avoid rescanning on every put.
+    entries = []
+    for f in self.root.glob('*/*.mp3'):
+      st = swallow(f.stat)
+      if st: entries.append((st.st_mtime, st.st_size, f))
+    entries.sort()
+    self.size = sum(size for _, size, _ in entries)
+    evicted = 0
+    for mtime, size, f in entries:
+      if self.size <= self.max_bytes * 0.9: break
+      swallow(f.unlink)
+      self.size -= size
+      evicted += 1
+    log.info('evicted %s segments from cache, now %s bytes', evicted, self.size)
+
+  def stats(self):
+    return dict(hits=self.hits, misses=self.misses)
+
+class TokenProvider(object):
+  """
+  Caches a bearer token from `source`, a callable returning (token, seconds until expiry).  Once the
+  token is within `margin` seconds of expiring it gets refreshed on a background thread, so callers
+  only block on the source for the very first token (or after a long idle spell).
+  """
+  def __init__(self, source, margin=300):
+    self.source = source
+    self.margin = margin
+    self.token = None
+    self.expires = 0
+    self.refreshing = False
+    self.lock = threading.Lock()
+
+  def get(self):
+    with self.lock:
+      now = time.monotonic()
+      if self.token is None or now >= self.expires - 30:
+        self.token, self.expires = self.fetch()
+      elif now >= self.expires - self.margin and not self.refreshing:
+        self.refreshing = True
+        threading.Thread(target=self.refresh, name='token-refresh', daemon=True).start()
+      return self.token
+
+  def fetch(self):
+    token, expires_in = self.source()
+    log.info('got new access token, expires in %ss', expires_in)
+    return token, time.monotonic() + expires_in
+
+  def refresh(self):
+    try:
+      token, expires = self.fetch()
+      with self.lock:
+        self.token, self.expires = token, expires
+    except Exception:
+      log.exception('error refreshing access token')
+    finally:
+      self.refreshing = False
+
+  def invalidate(self):
+    with self.lock:
+      self.token = None
+
+def gcloud_token_source():
+  token = subp.check_output('gcloud auth application-default print-access-token'.split()).strip().decode('utf8')
+  # gcloud doesn't tell us when the token expires, so ask, and assume the worst if we can't.
+  info = swallow(lambda: requests.get('https://oauth2.googleapis.com/tokeninfo',
+                                      params=dict(access_token=token), timeout=10).json())
+  return token, int(info['expires_in']) if info and 'expires_in' in info else 300
+
+def service_account_token_source(path):
+  # Optional dependency: pip install google-auth
+  from google.oauth2 import service_account
+  from google.auth.transport.requests import Request
+  creds = service_account.Credentials.from_service_account_file(
+    path, scopes=['https://www.googleapis.com/auth/cloud-platform'])
+  def source():
+    creds.refresh(Request())
+    return creds.token, (creds.expiry - datetime.utcnow()).total_seconds()
+  return source
+
+def token_source(spec):
+  """
+  :param spec: One of `gcloud`, `service-account:PATH` or `static:TOKEN`.
+  """
+  kind, _, arg = spec.partition(':')
+  if kind == 'gcloud':
+    return gcloud_token_source
+  elif kind == 'service-account':
+    return service_account_token_source(arg)
+  elif kind == 'static':
+    return lambda: (arg, float('inf'))
+  else:
+    raise ValueError('unknown token source %r' % spec)
 
-  tempdir = pathlib.Path(tempfile.mkdtemp('web-reader'))
+TTS_URL = 'https://texttospeech.googleapis.com/v1/text:synthesize'
 
-  log.info('spooling %s segments (%s paragraphs, %s sentences) to temp dir %s', len(segs), len(paragraphs), len(sents), tempdir)
-  for i, seg in enumerate(segs):
-    headers = {
-      "Authorization": "Bearer " + auth_key,
-      "Content-Type": "application/json; charset=utf-8",
-    }
+tts_segments = metrics.registry.counter(
+  'webreader_tts_segments_total', 'Segments synthesized, by where the audio came from', ['source', 'voice'])
+tts_chars = metrics.registry.counter(
+  'webreader_tts_characters_total', 'Characters sent to the TTS API', ['voice'])
+tts_bytes = metrics.registry.counter(
+  'webreader_tts_audio_bytes_total', 'Bytes of audio synthesized, by where it came from', ['source', 'voice'])
+
+class Synthesizer(object):
+  """
+  Synthesizes segments against the TTS API, running up to `concurrency` requests at once while
+  keeping the overall request rate under `qps` (the default TTS quota is 1000 requests/minute).
+  Segments found in `cache` skip the API entirely.  With `ssml`, segments are SSML rather than text.
+  """
+  def __init__(self, url=TTS_URL, concurrency=8, qps=1000 / 60, cache=None, tokens=None, ssml=False):
+    self.url = url
+    self.ssml = ssml
+    self.tokens = tokens or TokenProvider(gcloud_token_source)
+    self.concurrency = concurrency
+    # How many segments may be in flight or finished-but-unconsumed at once, which bounds memory.
+    self.window = 2 * concurrency
+    self.limiter = TokenBucket(qps)
+    self.cache = cache
+
+  def synthesize(self, seg, enhanced=False):
     data = {
       'input':{
-        'text': seg
+        ('ssml' if self.ssml else 'text'): seg
       },
       'voice':{
         'languageCode': 'en-US',
@@ -274,145 +1162,904 @@ def convert_text(title, text, outpath, enhanced=False):
         'audioEncoding':'MP3'
       }
     }
-    resp = post_with_retries('https://texttospeech.googleapis.com/v1/text:synthesize',
-                            data=json.dumps(data), headers=headers, debug_desc=seg)
+    voice = data['voice']['name']
+    key = SegmentCache.key(data) if self.cache else None
+    if key:
+      audio = self.cache.get(key)
+      if audio is not None:
+        tts_segments.inc(source='cache', voice=voice)
+        tts_bytes.inc(len(audio), source='cache', voice=voice)
+        return audio
+    with span('rate_limit'):
+      self.limiter.acquire()
+    try:
+      resp = self.post(data, seg)
+    except requests.HTTPError as ex:
+      if ex.response.status_code != 401: raise
+      log.warning('access token rejected, fetching a new one')
+      self.tokens.invalidate()
+      resp = self.post(data, seg)
+    audio = base64.b64decode(resp.json()['audioContent'])
+    tts_segments.inc(source='api', voice=voice)
+    tts_chars.inc(len(seg), voice=voice)
+    tts_bytes.inc(len(audio), source='api', voice=voice)
+    if key:
+      self.cache.put(key, audio)
+    return audio
+
+  def post(self, data, seg):
+    headers = {
+      "Authorization": "Bearer " + self.tokens.get(),
+      "Content-Type": "application/json; charset=utf-8",
+    }
+    with span('tts'):
+      resp = post_with_retries(self.url, data=json.dumps(data), headers=headers, debug_desc=seg)
     resp.raise_for_status()
-    data = base64.b64decode(resp.json()['audioContent'])
-    (tempdir / ('%s.mp3' % i)).write_bytes(data)
-
-  # From https://stackoverflow.com/questions/5276253/create-a-silent-mp3-from-the-command-line
-  # Must use 24kHz to match the mp3s from Google (without needing transcoding)
-  subp.check_call('''
-  ffmpeg -hide_banner -loglevel error -f lavfi -i anullsrc=r=24000:cl=mono -t 0.5 -q:a 9 -acodec libmp3lame %s
-  ''' % (tempdir / 'join-silence.mp3'), shell=True)
-  subp.check_call('''
-  ffmpeg -hide_banner -loglevel error -f lavfi -i anullsrc=r=24000:cl=mono -t 1 -q:a 9 -acodec libmp3lame %s
-  ''' % (tempdir / 'end-silence.mp3'), shell=True)
-
-  # From https://superuser.com/questions/314239/how-to-join-merge-many-mp3-files
-  # join_spec should look like:
-  # /tmp/tmplVPQHgweb-reader/0.mp3|/tmp/tmplVPQHgweb-reader/join-silence.mp3|/tmp/tmplVPQHgweb-reader/1.mp3|/tmp/tmplVPQHgweb-reader/end-silence.mp3
-  join_spec = '|'.join(list(itertools.chain(
-    *zip(
-      [str(tempdir / ('%s.mp3' % i)) for i in range(len(segs))],
-      [str( tempdir / 'join-silence.mp3' ) for i in range(len(segs))]
-    )
-  ))[:-1] + [str(tempdir / 'end-silence.mp3')])
+    return resp
+
+  def synthesize_stream(self, segs, enhanced=False):
+    """
+    Yields the MP3 data for each of `segs` (which may be lazy), in order, pulling segments only as
+    fast as the output is consumed.
+    """
+    with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='tts') as executor:
+      pending = collections.deque()
+      try:
+        for seg in segs:
+          pending.append(executor.submit(self.synthesize, seg, enhanced))
+          if len(pending) >= self.window:
+            yield pending.popleft().result()
+        while pending:
+          yield pending.popleft().result()
+      finally:
+        for future in pending:
+          future.cancel()
+
+synthesizer = Synthesizer()
+
+def append_segment(joiner, data):
+  with span('join'):
+    try:
+      joiner.append(data)
+    except mpeg.FormatMismatch as ex:
+      log.warning('transcoding segment with ffmpeg: %s', ex)
+      with span('transcode'):
+        data = mpeg.transcode(data, joiner.sample_rate, joiner.mono)
+      joiner.append(data)
+
+class PunktBackend(object):
+  """
+  nltk's punkt model.  It has no batch mode, and tokenizing paragraphs joined together could move
+  sentence boundaries, so each paragraph is still tokenized on its own.
+  """
+  def __init__(self):
+    self.model = nltk.data.load('tokenizers/punkt/english.pickle')
+
+  def tokenize_batch(self, paragraphs):
+    tokenize = self.model.tokenize
+    return [tokenize(par) for par in paragraphs]
+
+class RegexBackend(object):
+  """
+  Splits after sentence-ending punctuation.  Several times faster than punkt, but naive about
+  abbreviations and initials, so its sentences (and hence audio) differ.
+  """
+  boundary = re.compile(r'(?<=[.!?])\s+|(?<=[.!?]["\')\]])\s+')
+
+  def tokenize_batch(self, paragraphs):
+    return [[sent for sent in self.boundary.split(par) if sent] for par in paragraphs]
 
-  subp.check_call('''ffmpeg -hide_banner -loglevel error -i 'concat:%s' -acodec copy %s''' % (join_spec, outpath), shell=True)
+SEGMENTER_BACKENDS = dict(punkt=PunktBackend, regex=RegexBackend)
 
-  log.info('done converting %s', title)
+class Segmenter(object):
+  """
+  Splits an article into sentences, skipping anything without letters in it.  Paragraphs are
+  handed to the backend in batches of up to `batch_size`, so the segment stage is timed once per
+  batch rather than once per paragraph, and output is still produced lazily.  This doesn't speed up
+  tokenization itself, which backends may still do paragraph by paragraph.
+  """
+  def __init__(self, backend='punkt', batch_size=256):
+    self.backend = SEGMENTER_BACKENDS[backend]()
+    self.batch_size = batch_size
+
+  def sentences(self, title, text):
+    pars = (
+      par.strip()
+      for par in itertools.chain([title], newlines.split(text.strip()))
+      if par and alpha.search(par)
+    )
+    while True:
+      batch = list(itertools.islice(pars, self.batch_size))
+      if not batch:
+        break
+      with span('segment'):
+        batch_sents = self.backend.tokenize_batch(batch)
+      for sents in batch_sents:
+        for sent in sents:
+          if alpha.search(sent):
+            yield sent
+
+segmenter_backend = 'punkt'
+_segmenters = {}
+
+def get_segmenter(backend=None):
+  """The process-wide Segmenter for `backend`, so its model is only loaded once."""
+  backend = backend or segmenter_backend
+  if backend not in _segmenters:
+    _segmenters[backend] = Segmenter(backend)
+  return _segmenters[backend]
+
+def sentences(title, text):
+  return get_segmenter().sentences(title, text)
+
+def partial_paths(outpath, attempt=None):
+  """Where the partial output of `outpath` and its progress are written, by the lease `attempt`."""
+  name = outpath.name if attempt is None else '%s.%s' % (outpath.name, attempt)
+  return outpath.with_name(name + '.partial'), outpath.with_name(name + '.progress')
+
+def adopt_partial(outpath, attempt):
+  """Copies the latest earlier lease's partial output of `outpath`, if any, for `attempt` to resume."""
+  partpath, progresspath = partial_paths(outpath, attempt)
+  for earlier in list(range(attempt - 1, 0, -1)) + [None]:
+    old_partpath, old_progresspath = partial_paths(outpath, earlier)
+    try:
+      # Its partial output is always at least as far along as its progress said beforehand.
+      progress = old_progresspath.read_bytes()
+      tmp = temp_path(partpath)
+      shutil.copyfile(old_partpath, tmp)
+    except FileNotFoundError:
+      continue
+    os.replace(tmp, partpath)
+    atomic_write(progresspath, progress)
+    log.info('resuming from the partial output of lease %s', earlier)
+    return
+
+def convert_text(title, text, outpath, enhanced=False, heartbeat=None):
+  """
+  Streams sentences through segmentation and synthesis into `outpath`, appending audio as each
+  segment completes.  Progress is checkpointed alongside the output, so re-running an interrupted
+  conversion of the same text resumes after the last completed segment.  If given, `heartbeat` is
+  checked before each segment is written, to stop as soon as the task's lease is lost, and the
+  lease is confirmed with the DB before the finished MP3 replaces `outpath`.  Each lease writes its
+  own partial output, starting from a copy of the last lease's, so a converter that hasn't noticed
+  it lost its lease yet can't clobber the new owner's.
+  """
+  log.info('converting %s', title)
+  outpath = pathlib.Path(outpath)
+  partpath, progresspath = partial_paths(outpath, heartbeat.attempt if heartbeat else None)
+  if heartbeat and not partpath.exists():
+    adopt_partial(outpath, heartbeat.attempt)
+  fingerprint = hashlib.sha256(json.dumps(
+    [title, text, enhanced, synthesizer.ssml, SEGMENTS_VERSION]).encode('utf8')).hexdigest()
+  progress = swallow(lambda: json.loads(progresspath.read_text()))
+  if not progress or progress['fingerprint'] != fingerprint or not partpath.exists():
+    progress = dict(fingerprint=fingerprint, segments=0, joiner=None)
+
+  segs = segments(sentences(title, text), ssml=synthesizer.ssml)
+  if progress['segments'] > 0:
+    log.info('resuming after %s segments', progress['segments'])
+    segs = itertools.islice(segs, progress['segments'], None)
+
+  # Google's MP3s are 24kHz mono, so they can be joined frame by frame with no transcoding.
+  log.info('synthesizing into %s', partpath)
+  with open(partpath, 'r+b' if progress['joiner'] else 'wb') as f:
+    joiner = mpeg.Mp3Joiner(f, sample_rate=24000, mono=True, resume=progress['joiner'])
+    for data in synthesizer.synthesize_stream(segs, enhanced):
+      if heartbeat:
+        heartbeat.check()
+      # SSML segments start with their own pause.
+      if progress['segments'] > 0 and not synthesizer.ssml:
+        joiner.append_silence(0.5)
+      append_segment(joiner, data)
+      f.flush()
+      progress['segments'] += 1
+      progress['joiner'] = joiner.state
+      atomic_write(progresspath, json.dumps(progress))
+    joiner.append_silence(1)
+    joiner.close()
+  if heartbeat:
+    heartbeat.verify()
+  os.replace(partpath, outpath)
+  # Earlier leases' leftovers too, now that nothing will resume from them.
+  for path in outpath.parent.glob(outpath.name + '*.progress'):
+    path.unlink(missing_ok=True)
+  for path in outpath.parent.glob(outpath.name + '.*.partial'):
+    path.unlink(missing_ok=True)
+
+  log.info('done converting %s: %s segments, %.0fs of audio', title, progress['segments'], joiner.duration)
+  if synthesizer.cache:
+    log.info('segment cache stats: %r', synthesizer.cache.stats())
+  log.info('HTTP request stats: %r', request_stats())
   return title, text
 
-def req_with_retries(method, url, debug_desc, **kw):
+class CircuitOpenException(Exception):
+  pass
+
+class CircuitBreaker(object):
+  """
+  Trips after `threshold` consecutive failures against a host, failing requests to it immediately
+  for `cooldown` seconds.  After that, requests are let through again; one more failure re-trips it
+  and a success resets it.
+  """
+  def __init__(self, host, threshold=5, cooldown=60):
+    self.host = host
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.failures = 0
+    self.opened = None
+    self.lock = threading.Lock()
+
+  def check(self):
+    with self.lock:
+      if self.opened is not None and time.monotonic() - self.opened < self.cooldown:
+        raise CircuitOpenException('%s failed %s times in a row, not retrying for %ss' % (
+          self.host, self.failures, int(self.cooldown - (time.monotonic() - self.opened))))
+
+  def record(self, ok):
+    with self.lock:
+      if ok:
+        self.failures = 0
+        self.opened = None
+      else:
+        self.failures += 1
+        if self.failures >= self.threshold:
+          self.opened = time.monotonic()
+
+# Per-host circuit breakers and request counters (requests, retries, failures, seconds).
+breakers = {}
+http_stats = collections.defaultdict(collections.Counter)
+stats_lock = threading.Lock()
+
+http_pool_size = 16
+_session = None
+_session_pid = None
+
+def http_session():
+  """
+  A keep-alive session shared by all threads in this process (connection pools don't survive a
+  fork, so each process gets its own).
+  """
+  global _session, _session_pid
+  if _session is None or _session_pid != os.getpid():
+    _session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=http_pool_size)
+    _session.mount('https://', adapter)
+    _session.mount('http://', adapter)
+    _session_pid = os.getpid()
+  return _session
+
+def breaker_for(host):
+  with stats_lock:
+    if host not in breakers:
+      breakers[host] = CircuitBreaker(host)
+    return breakers[host]
+
+upstream_counters = {
+  key: metrics.registry.counter('webreader_upstream_%s_total' % key, desc, ['host'])
+  for key, desc in [
+    ('requests', 'Outgoing HTTP requests, including retries'),
+    ('retries', 'Outgoing HTTP requests retried after a transient failure'),
+    ('failures', 'Outgoing HTTP requests that failed for good'),
+    ('circuit_open', 'Outgoing HTTP requests refused by an open circuit breaker'),
+    ('seconds', 'Seconds spent on outgoing HTTP requests'),
+  ]
+}
+
+def count(host, **deltas):
+  with stats_lock:
+    http_stats[host].update(deltas)
+  for key, delta in deltas.items():
+    upstream_counters[key].inc(delta, host=host)
+
+def request_stats():
+  """Counts of outgoing HTTP requests, retries, failures and seconds spent, per host."""
+  with stats_lock:
+    return {host: dict(counts) for host, counts in http_stats.items()}
+
+# Request timeouts, rate limiting, and server errors are worth retrying; other 4xx errors never are.
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+def retry_delay(trial, resp=None, cap=120):
+  retry_after = resp.headers.get('Retry-After') if resp is not None else None
+  if retry_after:
+    delay = swallow(lambda: float(retry_after))
+    if delay is None:
+      delay = swallow(lambda: (parsedate_to_datetime(retry_after) - datetime.now(pytz.UTC)).total_seconds())
+    if delay is not None:
+      return min(cap, max(0, delay))
+  return min(cap, 2 ** trial) * random.uniform(0.5, 1.5)
+
+def req_with_retries(method, url, debug_desc, tries=5, deadline=None, **kw):
   """
+  Makes a request over the shared session, retrying transient failures with jittered exponential
+  backoff (or as long as the server's Retry-After says).  Non-retryable 4xx responses fail on the
+  first try, and requests to a host whose circuit breaker has tripped fail without being sent.  Only
+  requests that run out of retries count against the breaker, and not for rate limiting (429s), and
+  tripping it doesn't cut short requests already under way.  With a `deadline` (in time.monotonic()
+  terms), timeouts are cut short and retries given up on so as to finish by then.
+
   :param debug_desc: What to print instead of the URL when logging retries.
   :rtype: requests.Response
   """
-  a, b, c = None, None, None # just to silence pycharm code check
   details = '%s with %s' % (url, kw)
   debug_desc = '%s (%s)' % (debug_desc, details) if debug_desc else details
-  _ex = None
-  for trial in range(5):
+  host = urlsplit(url).netloc
+  breaker = breaker_for(host)
+  timeout = kw.pop('timeout', 30)
+  try:
+    breaker.check()
+  except CircuitOpenException:
+    count(host, circuit_open=1)
+    raise
+  for trial in range(tries):
+    start = time.monotonic()
+    resp = None
     try:
-      resp = getattr(requests, method)(url, timeout=30, **kw)
-      try:
-        resp.raise_for_status()
-        return resp
-      except Exception as ex:
-        log.warn(f'got API status {resp.status_code} error {resp.content}')
-        raise
+      try_timeout = timeout
+      if deadline is not None:
+        left = max(0.1, deadline - start)
+        try_timeout = tuple(min(t, left) for t in timeout) if isinstance(timeout, tuple) else min(timeout, left)
+      resp = http_session().request(method, url, timeout=try_timeout, **kw)
+      resp.raise_for_status()
     except Exception as ex:
-      log.warn(f'used trial #{trial + 1} of 5 on {debug_desc} for data {kw["data"] if "data" in kw else None}')
-      _ex = ex
-      if trial + 1 < 5: time.sleep(5)
-  else:
-    raise _ex
+      count(host, requests=1, seconds=time.monotonic() - start)
+      if resp is not None:
+        log.warn(f'got API status {resp.status_code} error {"(streamed)" if kw.get("stream") else resp.content}')
+        if kw.get('stream'):
+          resp.close()
+        if resp.status_code not in RETRYABLE_STATUSES:
+          count(host, failures=1)
+          raise
+      log.warn(f'used trial #{trial + 1} of {tries} on {debug_desc} for data {kw["data"] if "data" in kw else None}')
+      delay = retry_delay(trial, resp)
+      if trial + 1 == tries or (deadline is not None and time.monotonic() + delay >= deadline):
+        count(host, failures=1)
+        # A host that's rate limiting us is up; it just wants us to slow down.
+        if resp is None or resp.status_code != 429:
+          breaker.record(False)
+        raise
+      count(host, retries=1)
+      time.sleep(delay)
+    else:
+      count(host, requests=1, seconds=time.monotonic() - start)
+      breaker.record(True)
+      return resp
 
 def get_with_retries(url, debug_desc=None, **kw):
   return req_with_retries('get', url, debug_desc, **kw)
 def post_with_retries(url, debug_desc=None, **kw):
   return req_with_retries('post', url, debug_desc, **kw)
 
-def init_db(pq, engine):
-  Base.metadata.drop_all(bind=engine)
-  Base.metadata.create_all(bind=engine)
-  pq.create()
+# Schema changes, in order.  Each is a list of statements run in one transaction, after which the
+# DB's schema_version is the migration's (1-based) position in the list.  Never edit or reorder
+# migrations that have shipped; append new ones.  They're written to be no-ops on DBs that were
+# created or upgraded by hand before migrations existed.
+MIGRATIONS = [
+  # The original schema.
+  [
+    '''
+      create table if not exists articles (
+        id serial primary key, url varchar, created timestamp not null, title varchar, body varchar,
+        converted timestamp
+      )
+    ''',
+  ],
+  # Pre-rendered feed items and MP3 details.
+  [
+    '''
+      alter table articles
+        add column if not exists feed_item varchar,
+        add column if not exists mp3_bytes integer,
+        add column if not exists mp3_duration double precision,
+        add column if not exists mp3_enhanced boolean
+    ''',
+  ],
+  # Per-stage conversion timings.
+  ['alter table articles add column if not exists timings json'],
+  # The task queue.
+  [
+    '''
+      create table if not exists tasks (
+        id serial primary key, article_id integer not null, enhanced boolean not null,
+        lane varchar not null, priority integer not null, cost integer not null,
+        source varchar not null, turn integer not null, enqueued_at timestamp not null,
+        due_at timestamp not null, dequeued_at timestamp
+      )
+    ''',
+    'create index if not exists tasks_pending on tasks (priority, turn, due_at) where dequeued_at is null',
+  ],
+  # For the feed (newest converted articles, and the last conversion time) and URL lookups.
+  [
+    'create index if not exists articles_created on articles (created)',
+    'create index if not exists articles_converted_created on articles (created) where converted is not null',
+    'create index if not exists articles_converted on articles (converted)',
+    'create index if not exists articles_url_md5 on articles (md5(url))',
+  ],
+  # Per-URL summary of articles, kept up to date by a trigger, for finding URLs that never converted
+  # without aggregating over every article body.  `best_id` is the article with the longest body.
+  [
+    '''
+      create table url_status (
+        url_md5 varchar primary key, url varchar not null, last_created timestamp not null,
+        converted boolean not null, best_id integer not null, best_length integer not null
+      )
+    ''',
+    '''
+      create index url_status_unconverted on url_status (last_created) where not converted
+    ''',
+    '''
+      create function update_url_status() returns trigger as $$
+      begin
+        if trim(coalesce(new.url, '')) = '' then
+          return null;
+        end if;
+        insert into url_status as s (url_md5, url, last_created, converted, best_id, best_length)
+        values (md5(new.url), new.url, new.created, new.converted is not null, new.id,
+                coalesce(length(new.body), 0))
+        on conflict (url_md5) do update set
+          last_created = greatest(s.last_created, excluded.last_created),
+          converted = s.converted or excluded.converted,
+          best_id = case when excluded.best_length > s.best_length or excluded.best_id = s.best_id
+                         then excluded.best_id else s.best_id end,
+          best_length = case when excluded.best_length > s.best_length or excluded.best_id = s.best_id
+                             then excluded.best_length else s.best_length end;
+        return null;
+      end
+      $$ language plpgsql
+    ''',
+    '''
+      create trigger articles_url_status
+      after insert or update of url, created, body, converted on articles
+      for each row execute procedure update_url_status()
+    ''',
+    '''
+      insert into url_status (url_md5, url, last_created, converted, best_id, best_length)
+      select distinct on (md5(url))
+        md5(url), url,
+        max(created) over (partition by md5(url)),
+        bool_or(converted is not null) over (partition by md5(url)),
+        id, coalesce(length(body), 0)
+      from articles
+      where trim(coalesce(url, '')) != ''
+      order by md5(url), length(body) desc nulls last, id
+    ''',
+  ],
+  # Task leases.  Tasks claimed before this were done, since claiming used to share a transaction
+  # with converting.
+  [
+    '''
+      alter table tasks
+        add column if not exists state varchar not null default 'pending',
+        add column if not exists claimed_by varchar,
+        add column if not exists lease_until timestamp,
+        add column if not exists attempts integer not null default 0,
+        add column if not exists last_error varchar
+    ''',
+    "update tasks set state = 'done' where dequeued_at is not null",
+    'drop index if exists tasks_pending',
+    "create index tasks_pending on tasks (priority, turn, due_at) where state = 'pending'",
+    "create index tasks_leased on tasks (lease_until) where state = 'leased'",
+    "create index tasks_dead on tasks (id) where state = 'dead'",
+  ],
+  # The feed version, for checking cheaply whether the cached feed is stale.
+  [
+    'create table if not exists feed_version (id integer primary key, version integer not null)',
+    'insert into feed_version (id, version) values (1, 0) on conflict do nothing',
+  ],
+]
+
+def schema_version(conn):
+  if not sa.inspect(conn).has_table('schema_version'):
+    return 0
+  return conn.exec_driver_sql('select coalesce(max(version), 0) from schema_version').scalar()
+
+def migrate(engine):
+  """Brings the DB schema up to date, without touching existing data."""
+  with engine.begin() as conn:
+    conn.exec_driver_sql('create table if not exists schema_version (version integer not null)')
+  for version, statements in enumerate(MIGRATIONS, 1):
+    with engine.begin() as conn:
+      # Serializes concurrent migrations.
+      conn.exec_driver_sql('lock table schema_version')
+      if schema_version(conn) >= version:
+        continue
+      for statement in statements:
+        conn.exec_driver_sql(statement)
+      conn.exec_driver_sql('insert into schema_version (version) values (%s)' % version)
+    log.info('migrated DB to schema version %s', version)
+
+def check_schema(engine):
+  with engine.connect() as conn:
+    version = schema_version(conn)
+  if version < len(MIGRATIONS):
+    raise Exception('DB schema is at version %s but needs version %s; run `web-reader migrate`' % (
+      version, len(MIGRATIONS)))
+
+class Mp3Store(object):
+  """
+  Article MP3s, sharded into up to 256 subdirectories of `root` by a hash of the article ID, since
+  lookups in a single directory of hundreds of thousands of files get slow.  MP3s written directly
+  into `root` by earlier versions are still found, and moved into their shards by `gc`.
+  """
+  def __init__(self, root):
+    self.root = pathlib.Path(root)
+
+  @staticmethod
+  def name(article_id, enhanced=False):
+    return ('%s-enhanced.mp3' if enhanced else '%s.mp3') % article_id
+
+  def path(self, article_id, enhanced=False):
+    """Where the MP3 is written."""
+    shard = hashlib.md5(str(article_id).encode('ascii')).hexdigest()[:2]
+    return self.root / shard / self.name(article_id, enhanced)
+
+  def legacy_path(self, article_id, enhanced=False):
+    return self.root / self.name(article_id, enhanced)
+
+  def find(self, article_id, enhanced=False):
+    """Where the MP3 is, falling back to where it would be written if it doesn't exist."""
+    path = self.path(article_id, enhanced)
+    if not path.exists():
+      legacy = self.legacy_path(article_id, enhanced)
+      if legacy.exists():
+        return legacy
+    return path
+
+  def written(self, article_id, enhanced=False):
+    """Removes any legacy copy of an MP3 that was just written to its shard."""
+    self.legacy_path(article_id, enhanced).unlink(missing_ok=True)
+
+  def files(self):
+    """Yields (path, stat) for every file in the store, sharded or legacy."""
+    for path in itertools.chain(self.root.glob('*'), self.root.glob('??/*')):
+      st = swallow(path.stat)
+      if st is not None and not path.is_dir():
+        yield path, st
+
+  def reencode(self, path, bitrate):
+    """Re-encodes an MP3 in place at `bitrate` bits/sec, via a rename so it's never half-written."""
+    tmp = temp_path(path)
+    try:
+      with span('transcode'):
+        mpeg.reencode(path, tmp, bitrate)
+      os.replace(tmp, path)
+    finally:
+      tmp.unlink(missing_ok=True)
+
+  def gc(self, max_age=timedelta(days=7)):
+    """
+    Moves legacy MP3s into their shards and deletes superseded files: standard MP3s of articles that
+    have an enhanced one (which is what gets served), legacy MP3s that were since rewritten, and
+    leftovers of interrupted conversions and writes older than `max_age`.  Also deletes temp
+    directories older than `max_age` left behind by versions that converted via ffmpeg.  Returns
+    counts of what it did.
+    """
+    done = collections.Counter()
+    cutoff = time.time() - max_age.total_seconds()
+    for path, st in list(self.files()):
+      stem = path.name.split('.', 1)[0]
+      if path.suffix in ('.partial', '.progress', '.tmp'):
+        if st.st_mtime < cutoff:
+          path.unlink(missing_ok=True)
+          done['stale'] += 1
+          done['freed_bytes'] += st.st_size
+      elif path.suffix == '.mp3' and re.fullmatch(r'\d+(-enhanced)?', stem):
+        article_id, enhanced = int(stem.split('-')[0]), stem.endswith('-enhanced')
+        sharded = self.path(article_id, enhanced)
+        if not enhanced and self.find(article_id, True).exists():
+          path.unlink(missing_ok=True)
+          done['superseded'] += 1
+          done['freed_bytes'] += st.st_size
+        elif path != sharded:
+          if sharded.exists():
+            path.unlink(missing_ok=True)
+            done['superseded'] += 1
+            done['freed_bytes'] += st.st_size
+          else:
+            sharded.parent.mkdir(exist_ok=True)
+            os.replace(path, sharded)
+            done['moved'] += 1
+    for path in pathlib.Path(tempfile.gettempdir()).glob('tmp*web-reader'):
+      st = swallow(path.stat)
+      if st is not None and path.is_dir() and st.st_mtime < cutoff:
+        done['freed_bytes'] += dir_bytes(path)
+        shutil.rmtree(path, ignore_errors=True)
+        done['temp_dirs'] += 1
+    log.info('MP3 store gc: %r', dict(done))
+    return dict(done)
+
+  def usage(self):
+    """Counts and bytes of each kind of file in the store, plus free space on its filesystem."""
+    kinds = collections.defaultdict(lambda: dict(files=0, bytes=0))
+    shards = set()
+    for path, st in self.files():
+      if path.suffix in ('.partial', '.progress', '.tmp'):
+        kind = 'in_progress'
+      elif path.suffix != '.mp3':
+        kind = 'other'
+      elif path.parent == self.root:
+        kind = 'legacy'
+      else:
+        kind = 'enhanced' if path.stem.endswith('-enhanced') else 'standard'
+      if path.parent != self.root:
+        shards.add(path.parent.name)
+      kinds[kind]['files'] += 1
+      kinds[kind]['bytes'] += st.st_size
+    temp_dirs = [path for path in pathlib.Path(tempfile.gettempdir()).glob('tmp*web-reader') if path.is_dir()]
+    kinds['temp_dirs'] = dict(files=len(temp_dirs), bytes=sum(map(dir_bytes, temp_dirs)))
+    return dict(
+      root=str(self.root),
+      shards=len(shards),
+      total_bytes=sum(kind['bytes'] for kind in kinds.values()),
+      free_bytes=swallow(lambda: shutil.disk_usage(self.root).free),
+      **{name: kinds[name] for name in sorted(kinds)},
+    )
+
+def dir_bytes(path):
+  return sum(st.st_size for st in (swallow(f.stat) for f in pathlib.Path(path).rglob('*')) if st)
+
+mp3_store = Mp3Store(mp3dir)
 
 def mp3path(article):
-  return mp3dir / ('%s.mp3' % article.id)
+  return mp3_store.find(article.id)
 
 def enhanced_mp3_path(article):
-  return mp3dir / ('%s-enhanced.mp3' % article.id)
+  return mp3_store.find(article.id, True)
 
-def create_session():
-  engine = create_engine('postgresql://webreader@localhost/webreader')
-  pq = PQ(engine.raw_connection())
+def retain(keep=FEED_MAX_ITEMS, archive_kbps=16, evict=False, pretend=False):
+  """
+  Shrinks the MP3s of all but the latest `keep` converted articles, which have dropped out of the
+  feed: drops superseded standard MP3s and re-encodes the rest at `archive_kbps`, or with `evict`,
+  deletes them outright.  The articles' feed items and MP3 sizes are updated to match.  Articles
+  with conversions queued or under way are skipped.
+  """
+  with db_session.begin():
+    ids = [article_id for article_id, in db_session.query(Article.id)
+           .filter(Article.converted != None)
+           .order_by(Article.created.desc(), Article.id.desc())
+           .offset(keep)]
+    busy = {article_id for article_id, in db_session.query(Task.article_id)
+            .filter(Task.state.in_(['pending', 'leased']))}
+  done = collections.Counter()
+  for article_id in ids:
+    paths = [mp3_store.find(article_id, True), mp3_store.find(article_id)]
+    existing = [path for path in paths if path.exists()]
+    if not existing or article_id in busy or \
+       any(next(path.parent.glob(path.name + '*.partial'), None) for path in paths):
+      continue
+    before = sum(path.stat().st_size for path in existing)
+    if evict:
+      log.info('evicting MP3s of article %s', article_id)
+      if pretend: continue
+      for path in existing:
+        path.unlink(missing_ok=True)
+      served = None
+      done['evicted'] += 1
+    else:
+      served, superseded = existing[0], existing[1:]
+      seconds = mpeg.duration(served)
+      # Already archived, give or take the VBR header and a bit of rounding.
+      reencode = seconds > 0 and served.stat().st_size * 8 / seconds > archive_kbps * 1000 * 1.1
+      if not reencode and not superseded:
+        continue
+      log.info('archiving article %s', article_id)
+      if pretend: continue
+      for path in superseded:
+        path.unlink(missing_ok=True)
+      if reencode:
+        mp3_store.reencode(served, archive_kbps * 1000)
+      done['archived'] += 1
+    done['freed_bytes'] += before - (served.stat().st_size if served else 0)
+    with db_session.begin():
+      article = db_session.query(Article).get(article_id)
+      article.mp3_enhanced = served == paths[0] if served else None
+      article.mp3_bytes = served.stat().st_size if served else None
+      article.mp3_duration = mpeg.duration(served) if served else None
+      # Without audio there's nothing to put in the feed.
+      article.feed_item = served and render_feed_item(
+        article.id, article.url, article.created, article.title,
+        article.body and article.body[:FEED_DESCRIPTION_CHARS], article.mp3_bytes, article.mp3_duration)
+      bump_feed_version()
+  log.info('retention: %r', dict(done))
+  return dict(done)
+
+def create_session(pool_size=5, max_overflow=10, pool_pre_ping=False):
+  engine = create_engine('postgresql://webreader@localhost/webreader', pool_size=pool_size,
+                         max_overflow=max_overflow, pool_pre_ping=pool_pre_ping)
   db_session = scoped_session(sessionmaker(autocommit=True,
                                            autoflush=False,
                                            bind=engine))
-  return pq, db_session
+  return db_session
+
+def pool_options(cfg):
+  """create_session arguments from the command-line options, for sub-commands that have them."""
+  if not hasattr(cfg, 'db_pool_size'):
+    return {}
+  return dict(pool_size=cfg.db_pool_size, max_overflow=cfg.db_max_overflow, pool_pre_ping=cfg.db_pre_ping)
+
+@app.teardown_appcontext
+def remove_session(exc=None):
+  # Return each request's connection to the pool, however the request ended.
+  if db_session is not None:
+    db_session.remove()
+
+def run_webserver(cfg):
+  """
+  Serves the app with gunicorn if it's installed: `cfg.workers` processes of `cfg.threads` threads
+  each, so slow downloads only tie up a thread, never the whole server.  Otherwise falls back to
+  Flask's threaded development server.  Workers publish their metrics to a shared directory every
+  METRICS_INTERVAL seconds and as they exit, so whichever one serves `/metrics` reports them all.
+  """
+  global metrics_dir
+  try:
+    from gunicorn.app.base import BaseApplication
+  except ImportError:
+    log.warning('gunicorn is not installed, so using the Flask development server')
+    app.run(host=cfg.host, port=cfg.port, threaded=True)
+    return
+
+  def publish_metrics():
+    while True:
+      time.sleep(METRICS_INTERVAL)
+      metrics.publish(metrics_dir, metrics.registry.snapshot())
+
+  def post_fork(server, worker):
+    # Connections opened by the master (e.g. to check the schema) mustn't be shared with workers.
+    db_session.bind.dispose(close=False)
+    threading.Thread(target=publish_metrics, name='metrics', daemon=True).start()
+
+  def worker_exit(server, worker):
+    metrics.publish(metrics_dir, metrics.registry.snapshot())
+
+  def child_exit(server, worker):
+    # Runs in the master once the worker is gone, so its final snapshot is already published.
+    metrics.retire(metrics_dir, worker.pid)
+
+  class Server(BaseApplication):
+    def load_config(self):
+      settings = dict(
+        bind='%s:%s' % (cfg.host, cfg.port or 5000),
+        workers=cfg.workers,
+        threads=cfg.threads,
+        worker_class='gthread',
+        graceful_timeout=cfg.graceful_timeout,
+        pidfile=cfg.pid_file,
+        post_fork=post_fork,
+        worker_exit=worker_exit,
+        child_exit=child_exit,
+        accesslog='-' if cfg.access_log else None,
+      )
+      for key, value in settings.items():
+        self.cfg.set(key, value)
+
+    def load(self):
+      return app
+
+  metrics_dir = tempfile.mkdtemp(prefix='webreader-metrics-')
+  master = os.getpid()
+  try:
+    Server().run()
+  finally:
+    # Workers exit through here too.
+    if os.getpid() == master:
+      shutil.rmtree(metrics_dir, ignore_errors=True)
 
 def trunc_txt(s, max_chars=100):
   return s if len(s) < max_chars else s[:max_chars - 3] + '...'
 
 def resubmit(base_url, sort_order, pretend, limit=None, min_date=None):
-  pg, ses = create_session()
+  ses = db_session
   # Choose the longest body
   failures = ses.connection().execute(
     sa.text('''
-      select
-        max(created) as created,
-        url,
-        (array_agg(body order by length(body) desc))[1] as body
-      from articles
-      where trim(coalesce(url, '')) != ''
-      group by url
-      having bool_and(converted is null) and (:min_created is null or max(created) >= :min_created)
-      order by max(created) %(sort_order)s
+      select s.last_created, s.url, a.body
+      from url_status s
+      join articles a on a.id = s.best_id
+      where not s.converted and (:min_created is null or s.last_created >= :min_created)
+      order by s.last_created %(sort_order)s
       limit :limit
     ''' % dict(sort_order=sort_order)),
     min_created=min_date,
     limit=limit,
   ).fetchall()
+  batch = []
   for created, url, body in failures:
     log.info('submitting URL %s body %r', url, trunc_txt(body or ''))
-    if not pretend:
-      requests.get(pathlib.Path(base_url) / 'api/v1/enqueue', params=dict(url=url, body=body))
+    batch.append(dict(url=url, body=body))
+  if not pretend:
+    for i in range(0, len(batch), 500):
+      # Only tried once: enqueuing isn't idempotent, so a retry after a timeout or error the server
+      # had already committed through would enqueue everything twice.
+      resp = post_with_retries(base_url.rstrip('/') + '/api/v1/enqueue/batch', 'resubmit batch',
+                               tries=1, json=batch[i:i + 500])
+      log.info('enqueued article IDs %s', resp.json()['ids'])
 
 def reconvert(min_id, max_id, sort_order, pretend):
-  pg, ses = create_session()
-  # Choose the longest body
-  ids = ses.connection().execute(
-    sa.text('''
-      select id
-      from articles
-      where id between :min_id and :max_id
-      order by id %(sort_order)s
-    ''' % dict(sort_order=sort_order)),
-    min_id=min_id,
-    max_id=max_id
-  ).fetchall()
-  for [id] in ids:
-    log.info('re-converting ID %s', id)
+  with db_session.begin():
+    articles = db_session.execute(
+      sa.text('''
+        select id, url, length(body)
+        from articles
+        where id between :min_id and :max_id
+        order by id %(sort_order)s
+      ''' % dict(sort_order=sort_order)),
+      dict(min_id=min_id, max_id=max_id),
+    ).fetchall()
+    for id, url, body_length in articles:
+      log.info('re-converting ID %s', id)
     if not pretend:
-      queue.put(dict(article_id=id))
+      put_many([task_for(id, url, body_length, 'bulk') for id, url, body_length in articles])
 
 def main(argv=sys.argv):
-  global engine, db_session, pq, queue
+  global engine, db_session, synthesizer, http_pool_size, page_cache, segmenter_backend, \
+    max_page_bytes, fetch_deadline, max_attempts, mp3_store
 
   logging.basicConfig()
   log.setLevel(logging.INFO)
 
+  # Options shared by every sub-command that synthesizes audio.
+  synth_p = ArgumentParser(add_help=False)
+  synth_p.add_argument('--tts-url', default=TTS_URL,
+                       help='TTS synthesize endpoint (point this at a fake server for testing)')
+  synth_p.add_argument('--tts-concurrency', type=int, default=8,
+                       help='Max TTS requests in flight at once per process')
+  synth_p.add_argument('--tts-qps', type=float, default=1000 / 60,
+                       help='Max TTS requests per second (0 for unlimited); split across converter workers')
+  synth_p.add_argument('--tts-auth', default='gcloud',
+                       help='Where to get TTS access tokens: gcloud, service-account:KEYFILE or static:TOKEN')
+  synth_p.add_argument('--ssml', action='store_true',
+                       help='Send SSML, with pauses between segments, rather than plain text')
+  synth_p.add_argument('--segmenter', choices=sorted(SEGMENTER_BACKENDS), default='punkt',
+                       help='Sentence segmentation backend (regex is faster but less accurate)')
+  synth_p.add_argument('--segment-cache', default=str(cachedir / 'segments'),
+                       help='Directory to cache synthesized segment audio in')
+  synth_p.add_argument('--segment-cache-mb', type=int, default=2048,
+                       help='Evict least recently used cached segments beyond this size')
+  synth_p.add_argument('--no-segment-cache', action='store_true',
+                       help='Always synthesize, bypassing the segment cache')
+
+  # Options shared by every sub-command that fetches pages.
+  fetch_p = ArgumentParser(add_help=False)
+  fetch_p.add_argument('--page-cache', default=str(cachedir / 'pages'),
+                       help='Directory to cache fetched and extracted pages in')
+  fetch_p.add_argument('--page-cache-fresh', type=int, default=600,
+                       help='Use cached pages younger than this many seconds without revalidating them')
+  fetch_p.add_argument('--no-page-cache', action='store_true',
+                       help='Always fetch and extract pages, bypassing the page cache')
+  fetch_p.add_argument('--max-page-mb', type=float, default=10,
+                       help='Give up on pages bigger than this')
+  fetch_p.add_argument('--fetch-deadline', type=int, default=60,
+                       help='Give up on pages that take longer than this many seconds to fetch')
+
+  # Options shared by every sub-command that uses the DB.
+  db_p = ArgumentParser(add_help=False)
+  db_p.add_argument('--db-pool-size', type=int, default=5,
+                    help='DB connections to keep open per process')
+  db_p.add_argument('--db-max-overflow', type=int, default=10,
+                    help='Extra DB connections to open per process when the pool is exhausted')
+  db_p.add_argument('--db-pre-ping', action='store_true',
+                    help='Check DB connections are alive before using them (e.g. across DB restarts)')
+
+  # Options shared by every sub-command that reads or writes the MP3s.
+  mp3_p = ArgumentParser(add_help=False)
+  mp3_p.add_argument('--mp3-dir', default=str(mp3dir),
+                     help='Directory to store MP3s in (shared by the web server and all converter hosts)')
+
   p = ArgumentParser(description=__doc__)
   subparsers = p.add_subparsers(help='sub-command help', dest='cmd')
-  init_p = subparsers.add_parser('init')
-  converter_p = subparsers.add_parser('converter')
-  webserver_p = subparsers.add_parser('webserver')
-  convert_p = subparsers.add_parser('convert')
-  convert_file_p = subparsers.add_parser('convert-file')
-  resubmit_p = subparsers.add_parser('resubmit')
-  reconvert_p = subparsers.add_parser('reconvert')
+  init_p = subparsers.add_parser('init', parents=[db_p, mp3_p])
+  migrate_p = subparsers.add_parser('migrate', parents=[db_p])
+  converter_p = subparsers.add_parser('converter', parents=[synth_p, fetch_p, db_p, mp3_p])
+  webserver_p = subparsers.add_parser('webserver', parents=[db_p, mp3_p])
+  convert_p = subparsers.add_parser('convert', parents=[synth_p, fetch_p])
+  convert_file_p = subparsers.add_parser('convert-file', parents=[synth_p])
+  resubmit_p = subparsers.add_parser('resubmit', parents=[db_p])
+  reconvert_p = subparsers.add_parser('reconvert', parents=[db_p])
+  retain_p = subparsers.add_parser('retain', parents=[db_p, mp3_p])
+  gc_p = subparsers.add_parser('gc', parents=[mp3_p])
+  subparsers.add_parser('du', parents=[mp3_p])
+  bench_segment_p = subparsers.add_parser('bench-segment')
+  bench_p = subparsers.add_parser('bench')
 
   webserver_p.add_argument('-p', '--port', type=int,
                            help='Web server listen port')
@@ -420,6 +2067,18 @@ def main(argv=sys.argv):
                            help='Optional parameter `secret` to restrict enqueuing')
   webserver_p.add_argument('--base-url',
                            help='The base URL')
+  webserver_p.add_argument('--host', default='127.0.0.1',
+                           help='Address to listen on')
+  webserver_p.add_argument('-w', '--workers', type=int, default=2,
+                           help='Number of web server processes (with gunicorn)')
+  webserver_p.add_argument('--threads', type=int, default=8,
+                           help='Requests to handle at once per process (with gunicorn)')
+  webserver_p.add_argument('--graceful-timeout', type=int, default=30,
+                           help='Seconds to let in-flight requests finish on reload or shutdown (with gunicorn)')
+  webserver_p.add_argument('--pid-file',
+                           help='Write the server PID here, e.g. for `kill -HUP` to reload (with gunicorn)')
+  webserver_p.add_argument('--access-log', action='store_true',
+                           help='Log each request to stdout (with gunicorn)')
 
   converter_p.add_argument('-t', '--to',
                            help='Email to send notifications to (sent only if this is set)')
@@ -427,6 +2086,20 @@ def main(argv=sys.argv):
                            help='Email to send notifications as')
   converter_p.add_argument('--base-url',
                           help='The base URL to use in email links http://localhost:5000/ (excludes /api/...)')
+  converter_p.add_argument('-w', '--workers', type=int, default=4,
+                           help='Number of converter processes to run concurrently')
+  converter_p.add_argument('--max-tasks', type=int, default=50,
+                           help='Recycle each converter process after this many articles')
+  converter_p.add_argument('--max-rss-mb', type=int, default=1024,
+                           help='Recycle a converter process once its RSS exceeds this')
+  converter_p.add_argument('--enhanced-workers', type=int, default=1,
+                           help='Max converter processes working on enhanced articles at once')
+  converter_p.add_argument('--max-attempts', type=int, default=3,
+                           help='Give up on tasks after this many converter crashes or hangs')
+  converter_p.add_argument('--metrics-port', type=int,
+                           help='Serve Prometheus metrics for all converter processes on this port')
+  converter_p.add_argument('--record-timings', action='store_true',
+                           help="Save each conversion's per-stage timings in the articles table")
 
   convert_p.add_argument('url', help='URL to fetch')
   convert_p.add_argument('outpath', help='Output MP3 path')
@@ -454,81 +2127,97 @@ def main(argv=sys.argv):
   reconvert_p.add_argument('--pretend', action='store_true',
                           help='Only print the would-be resubmissions')
 
+  retain_p.add_argument('-k', '--keep', type=int, default=FEED_MAX_ITEMS,
+                        help='Leave the MP3s of this many of the latest articles alone')
+  retain_p.add_argument('--archive-kbps', type=int, default=16,
+                        help='Bitrate to re-encode older MP3s at')
+  retain_p.add_argument('--evict', action='store_true',
+                        help='Delete older MP3s rather than re-encoding them')
+  retain_p.add_argument('--pretend', action='store_true',
+                        help='Only print the would-be archivals or evictions')
+
+  gc_p.add_argument('--max-age-days', type=float, default=7,
+                    help='Only delete leftovers of interrupted conversions older than this')
+
+  bench_segment_p.add_argument('--corpus',
+                               help='Text file to segment (defaults to a fixed built-in corpus)')
+  bench_segment_p.add_argument('--backend', choices=sorted(SEGMENTER_BACKENDS), default='punkt',
+                               help='Segmentation backend to measure')
+  bench_segment_p.add_argument('-n', '--repeat', type=int, default=5,
+                               help='How many times to segment the text')
+  bench_segment_p.add_argument('--copies', type=int, default=200,
+                               help='How many copies of the corpus to join into the text, to make it book-length')
+
+  bench_p.add_argument('-n', '--articles', type=int, default=20,
+                       help='How many fixture articles to convert')
+  bench_p.add_argument('--tts-latency', type=float, default=0.05,
+                       help='Seconds the fake TTS server takes per request')
+  bench_p.add_argument('--tts-error-rate', type=float, default=0,
+                       help='Fraction of fake TTS requests that fail with a 503')
+  bench_p.add_argument('--tts-concurrency', type=int, default=8,
+                       help='Max TTS requests in flight at once')
+  bench_p.add_argument('--book-repeat', type=int, default=20,
+                       help='How many copies of the corpus make up each book-length article')
+  bench_p.add_argument('-o', '--output',
+                       help='Also write the JSON results to this file')
+
   cfg = p.parse_args(argv[1:])
   cmd = cfg.cmd
 
   log.info('command-line config: %r', cfg)
 
-  pq, db_session = create_session()
-
-  if cmd == 'init':
-    mp3dir.mkdir(parents=True, exist_ok=True)
-    init_db(pq, db_session.bind)
+  if hasattr(cfg, 'mp3_dir'):
+    mp3_store = Mp3Store(pathlib.Path(cfg.mp3_dir).expanduser())
+  if cmd == 'gc':
+    print(json.dumps(mp3_store.gc(timedelta(days=cfg.max_age_days))))
+    return
+  if cmd == 'du':
+    print(json.dumps(mp3_store.usage(), indent=2))
+    return
+  if cmd == 'bench-segment':
+    from webreader import bench
+    print(json.dumps(bench.segment_benchmark(cfg.corpus, cfg.backend, cfg.repeat, cfg.copies)))
+    return
+  if cmd == 'bench':
+    from webreader import bench
+    results = json.dumps(bench.run(cfg.articles, cfg.tts_latency, cfg.tts_error_rate,
+                                   cfg.tts_concurrency, cfg.book_repeat), indent=2)
+    print(results)
+    if cfg.output:
+      pathlib.Path(cfg.output).write_text(results)
     return
 
-  queue = pq['articles']
+  if hasattr(cfg, 'tts_url'):
+    segmenter_backend = cfg.segmenter
+    http_pool_size = max(http_pool_size, cfg.tts_concurrency)
+    cache = None if cfg.no_segment_cache else \
+      SegmentCache(cfg.segment_cache, cfg.segment_cache_mb * 1024 * 1024)
+    synthesizer = Synthesizer(cfg.tts_url, cfg.tts_concurrency, cfg.tts_qps, cache,
+                              TokenProvider(token_source(cfg.tts_auth)), cfg.ssml)
+  if hasattr(cfg, 'page_cache'):
+    max_page_bytes = int(cfg.max_page_mb * 2 ** 20)
+    fetch_deadline = cfg.fetch_deadline
+    if not cfg.no_page_cache:
+      page_cache = PageCache(cfg.page_cache, cfg.page_cache_fresh)
+
+  db_session = create_session(**pool_options(cfg))
+
+  if cmd in ('init', 'migrate'):
+    if cmd == 'init':
+      mp3_store.root.mkdir(parents=True, exist_ok=True)
+    migrate(db_session.bind)
+    return
+  if cmd in ('converter', 'webserver', 'resubmit', 'reconvert', 'retain'):
+    check_schema(db_session.bind)
 
   if cmd == 'converter':
-    while True:
-      with db_session.begin():
-        task = queue.get()
-        error_tb = None
-        if task is not None:
-          article = db_session.query(Article).get(task.data['article_id'])
-          log.info('processing %s', article.url)
-          enhanced = bool(task.data.get('enhanced'))
-          outpath = enhanced_mp3_path(article) if enhanced else mp3path(article)
-          try:
-            log.info('creating queue')
-            subprocess_queue = Queue()
-            log.info('creating process')
-            process = Process(target=worker, args=(subprocess_queue, article, enhanced, outpath))
-            log.info('starting process')
-            process.start()
-            log.info('joining process')
-            process.join()
-            log.info('joined process')
-            if process.exitcode != 0:
-              raise Exception('got exit code ' + str(process.exitcode))
-            result, error_tb = subprocess_queue.get()
-            assert bool(result) or bool(error_tb)
-            if error_tb:
-              raise TunneledException()
-            else:
-              if article.body is None:
-                article.title, article.body = result
-          # Include OSError to report things like OOMs when forking a process.
-          except TunneledException as ex:
-            log.exception('error processing article')
-            subj = 'AudioLizard | Error processing article'
-            assert error_tb is not None
-            msg = '\n\n'.join([article.url, error_tb, article.body or ''])
-          except (OSError, Exception) as ex:
-            log.exception('error processing article')
-            subj = 'AudioLizard | Error processing article'
-            msg = '\n\n'.join([article.url, traceback.format_exc(), article.body or ''])
-          else:
-            article.converted = datetime.now()
-            subj = 'AudioLizard | %s' % article.title or article.url
-            mp3_url = pathlib.Path(cfg.base_url) / 'mp3' / str(article.id) if cfg.base_url else ''
-            enhance_url = pathlib.Path(cfg.base_url) / 'mp3' / str(article.id) / 'enhance' if cfg.base_url else ''
-            msg = '\n\n'.join(filter(None, map(str, [article.title or '', article.url, mp3_url, enhance_url, article.body or ''])))
-          if cfg.to:
-            msg = MIMEText(msg, 'plain', 'utf-8')
-            msg['Subject'] = subj
-            msg['To'] = cfg.to
-            msg['From'] = getattr(cfg, 'from')
-            print(
-              subj
-            )
-            s = SMTP('localhost')
-            s.sendmail(getattr(cfg, 'from'), [cfg.to], msg.as_string())
-            s.quit()
+    max_attempts = cfg.max_attempts
+    run_converter(cfg)
   elif cmd == 'webserver':
     app.config['CORS_HEADERS'] = 'Content-Type'
     if cfg.secret: app.config['secret'] = cfg.secret
     if cfg.base_url: app.config['base_url'] = cfg.base_url or 'https://example.com'
-    app.run(port=cfg.port)
+    run_webserver(cfg)
   elif cmd == 'convert':
     convert(cfg.url, cfg.outpath)
   elif cmd == 'convert-file':
@@ -548,16 +2237,242 @@ def main(argv=sys.argv):
       pretend=cfg.pretend,
       sort_order=dict(newest='desc', oldest='asc')[cfg.order],
     )
+  elif cmd == 'retain':
+    print(json.dumps(retain(cfg.keep, cfg.archive_kbps, cfg.evict, cfg.pretend)))
   else:
     raise Exception()
 
 
-def worker(q, article, enhanced, outpath):
+def rss_mb():
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+  except OSError:
+    # Peak rather than current RSS, and in bytes rather than KB on OS X, but close enough.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+def notify(cfg, subj, msg):
+  if cfg.to:
+    msg = MIMEText(msg, 'plain', 'utf-8')
+    msg['Subject'] = subj
+    msg['To'] = cfg.to
+    msg['From'] = getattr(cfg, 'from')
+    print(
+      subj
+    )
+    s = SMTP('localhost')
+    s.sendmail(getattr(cfg, 'from'), [cfg.to], msg.as_string())
+    s.quit()
+
+articles_processed = metrics.registry.counter(
+  'webreader_articles_total', 'Articles the converter finished with, by outcome', ['result', 'voice'])
+audio_seconds = metrics.registry.counter(
+  'webreader_audio_seconds_total', 'Seconds of audio produced', ['voice'])
+task_wait_seconds = metrics.registry.histogram(
+  'webreader_task_wait_seconds', 'How long tasks waited in the queue before a converter took them',
+  ['lane'], buckets=(1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 86400))
+
+def process_task(cfg, task, heartbeat=None):
+  """
+  Converts a task's article, saves the result and finishes the task, and sends a notification.
+  The DB is only used to read the article and then to save it, in short transactions of their own,
+  so nothing is held open while converting.  Returns the article, or None if the task's lease was
+  lost (see Heartbeat), in which case it's left to whichever converter holds the lease now.
+  """
+  with db_session.begin():
+    article = db_session.query(Article).get(task.article_id)
+    # Detached, so it can be used outside the transaction.
+    db_session.expunge(article)
+  log.info('processing %s', article.url)
+  enhanced = task.enhanced
+  outpath = mp3_store.path(article.id, enhanced)
+  outpath.parent.mkdir(parents=True, exist_ok=True)
+  error = None
   try:
     if article.body is not None:
-      q.put((convert_text(None, article.body, outpath, enhanced), None))
+      result = convert_text(None, article.body, outpath, enhanced, heartbeat)
     else:
-      q.put((convert(article.url, outpath, enhanced), None))
-  except Exception as exc:
-    log.error('error processing article', exc_info=exc)
-    q.put((None, traceback.format_exc()))
+      result = convert(article.url, outpath, enhanced, heartbeat)
+    if article.body is None:
+      article.title, article.body = result
+  except LeaseLost:
+    log.warning('stopped processing article %s after losing the lease on task %s', article.id, task.id)
+    return None
+  except Exception as ex:
+    log.exception('error processing article')
+    articles_processed.inc(result='failed', voice='enhanced' if enhanced else 'standard')
+    error = repr(ex)
+    subj = 'AudioLizard | Error processing article'
+    msg = '\n\n'.join([article.url or '', traceback.format_exc(), article.body or ''])
+  else:
+    mp3_store.written(article.id, enhanced)
+    article.converted = datetime.now()
+    # Describe whichever MP3 the mp3 view will serve, which may be an earlier enhanced one.
+    article.mp3_enhanced = enhanced_mp3_path(article).exists()
+    served = enhanced_mp3_path(article) if article.mp3_enhanced else mp3path(article)
+    article.mp3_bytes = served.stat().st_size
+    article.mp3_duration = mpeg.duration(served)
+    articles_processed.inc(result='converted', voice='enhanced' if enhanced else 'standard')
+    audio_seconds.inc(article.mp3_duration, voice='enhanced' if article.mp3_enhanced else 'standard')
+    article.feed_item = render_feed_item(article.id, article.url, article.created, article.title,
+                                         article.body and article.body[:FEED_DESCRIPTION_CHARS],
+                                         article.mp3_bytes, article.mp3_duration)
+    subj = 'AudioLizard | %s' % article.title or article.url
+    mp3_url = pathlib.Path(cfg.base_url) / 'mp3' / str(article.id) if cfg.base_url else ''
+    enhance_url = pathlib.Path(cfg.base_url) / 'mp3' / str(article.id) / 'enhance' if cfg.base_url else ''
+    msg = '\n\n'.join(filter(None, map(str, [article.title or '', article.url, mp3_url, enhance_url, article.body or ''])))
+  with db_session.begin():
+    db_session.merge(article)
+    finish_task(task.id, task.claimed_by, error)
+    if error is None:
+      bump_feed_version()
+  with span('notify'):
+    notify(cfg, subj, msg)
+  return article
+
+# How often converter workers send their metrics to the parent, in seconds.
+METRICS_INTERVAL = 10
+
+def ship_metrics(snapshots):
+  while True:
+    time.sleep(METRICS_INTERVAL)
+    snapshots.put(metrics.registry.drain())
+
+# How long an idle converter waits before checking for tasks again, in seconds.
+POLL_INTERVAL = 1
+
+def worker_id(pid=None):
+  """Identifies a converter process across all the hosts sharing the queue."""
+  return '%s:%s' % (socket.gethostname(), pid or os.getpid())
+
+def given_up(dead):
+  """Looks up the URLs and bodies of the articles of `dead` tasks.  Must be called in a transaction."""
+  return [db_session.query(Article.url, Article.body).filter(Article.id == task.article_id).one()
+          for task in dead]
+
+def notify_given_up(cfg, articles, error):
+  for url, body in articles:
+    notify(cfg, 'AudioLizard | Error processing article', '\n\n'.join([url or '', error, body or '']))
+
+# Why tasks whose leases ran out are re-queued or given up on.
+LEASE_EXPIRED = 'lease expired'
+
+def claim_next(enhanced_slots, slot):
+  """
+  Claims the next task for a converter, including enhanced ones only if one of the `enhanced_slots`
+  is free.  If the task is enhanced, the slot is kept (and `slot` set, so the parent can free it
+  should we crash) until the caller releases it.  Also re-queues tasks whose leases ran out, on
+  whatever host.  Returns the task, if any, and the articles of tasks given up on (see given_up),
+  for the caller to report.
+  """
+  if enhanced_slots.acquire(block=False):
+    slot.value = 1
+  with db_session.begin():
+    dead = given_up(release_leases(Task.lease_until < db_now(), LEASE_EXPIRED))
+    task = claim_task([lane for lane in LANES if slot.value or lane != 'enhanced'], worker_id())
+    if task is not None:
+      # Detached, so it can be used outside the transaction.
+      db_session.flush()
+      db_session.expunge(task)
+  if slot.value and (task is None or task.lane != 'enhanced'):
+    slot.value = 0
+    enhanced_slots.release()
+  return task, dead
+
+def converter_worker(cfg, slot, enhanced_slots, snapshots):
+  """
+  Body of one long-lived converter process.  Pulls and converts tasks until it has done
+  `cfg.max_tasks` of them or its RSS passes `cfg.max_rss_mb`, then exits to be replaced.  Metric
+  increments are sent to the parent through `snapshots`.
+  """
+  global db_session, synthesizer
+  # Only report our own work, not whatever the parent had counted before forking.
+  metrics.registry.drain()
+  threading.Thread(target=ship_metrics, args=(snapshots,), name='metrics', daemon=True).start()
+  # Never reuse connections inherited across the fork.
+  db_session = create_session(**pool_options(cfg))
+  synthesizer.limiter = TokenBucket(cfg.tts_qps / cfg.workers)
+  # Warm up the models now rather than on the first task.
+  get_segmenter()
+  import trafilatura
+  if page_cache:
+    page_cache.prune()
+
+  done = 0
+  while done < cfg.max_tasks:
+    task, dead = claim_next(enhanced_slots, slot)
+    notify_given_up(cfg, dead, LEASE_EXPIRED)
+    if task is None:
+      time.sleep(POLL_INTERVAL)
+      continue
+    if task.attempts == 1:
+      task_wait_seconds.observe((task.dequeued_at - task.enqueued_at).total_seconds(), lane=task.lane)
+    metrics.current.reset()
+    with Heartbeat(task.id, task.claimed_by, task.attempts) as heartbeat, span('article'):
+      article = process_task(cfg, task, heartbeat)
+    if article is not None and cfg.record_timings:
+      with db_session.begin():
+        db_session.query(Article).filter(Article.id == article.id)\
+          .update(dict(timings=metrics.current.snapshot()), synchronize_session=False)
+    if slot.value:
+      slot.value = 0
+      enhanced_slots.release()
+    done += 1
+    if rss_mb() > cfg.max_rss_mb:
+      log.info('recycling worker at %.0f MB RSS', rss_mb())
+      break
+  snapshots.put(metrics.registry.drain())
+
+def run_converter(cfg):
+  """
+  Keeps `cfg.workers` converter processes running, replacing any that get recycled or crash.
+  Each worker gets its own process so a crash (e.g. OOM) only interrupts the article it was on, which
+  is then retried (see release_leases).  At most `cfg.enhanced_workers` of them work on enhanced
+  articles at once.
+  """
+  enhanced_slots = BoundedSemaphore(cfg.enhanced_workers)
+  totals = {}
+  totals_lock = threading.Lock()
+  snapshots = Queue()
+
+  def collect():
+    nonlocal totals
+    while True:
+      snapshot = snapshots.get()
+      with totals_lock:
+        totals = metrics.merge(totals, snapshot)
+
+  def scrape():
+    # Still report the workers' metrics if the DB is unreachable.
+    swallow(update_queue_metrics)
+    with totals_lock:
+      return metrics.merge(totals, metrics.registry.snapshot())
+
+  # Always drain the workers' metrics, even if nobody scrapes them, so their sends never block.
+  threading.Thread(target=collect, name='metrics-collector', daemon=True).start()
+  if cfg.metrics_port:
+    metrics.serve(cfg.metrics_port, scrape)
+    log.info('serving converter metrics on port %s', cfg.metrics_port)
+
+  workers = {}
+  while True:
+    while len(workers) < cfg.workers:
+      slot = Value('i', 0)
+      process = Process(target=converter_worker, args=(cfg, slot, enhanced_slots, snapshots))
+      process.start()
+      log.info('started converter worker %s', process.pid)
+      workers[process.sentinel] = process, slot
+    for sentinel in wait(list(workers)):
+      process, slot = workers.pop(sentinel)
+      process.join()
+      if slot.value:
+        enhanced_slots.release()
+      if process.exitcode == 0:
+        log.info('converter worker %s exited after recycling', process.pid)
+        continue
+      log.error('converter worker %s died with exit code %s', process.pid, process.exitcode)
+      error = 'converter worker got exit code %s' % process.exitcode
+      # Don't wait for its lease to run out.  Articles are only reported once they're given up on.
+      with db_session.begin():
+        dead = given_up(release_leases(Task.claimed_by == worker_id(process.pid), error))
+      notify_given_up(cfg, dead, error)
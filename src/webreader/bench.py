@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmarks.  Each returns a JSON-able dict of results so runs can be compared across
+versions.
+
+`run` drives the whole converter pipeline against a fake TTS server, a fake web site serving the
+fixture pages and a SQLite DB, so no network access, Google credentials or Postgres are needed.
+"""
+import importlib.metadata
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from datetime import datetime
+
+import nltk
+import sqlalchemy as sa
+from sqlalchemy.orm.scoping import scoped_session
+from sqlalchemy.orm.session import sessionmaker
+
+import webreader
+from webreader import fakes, metrics
+from webreader import swallow
+
+CORPUS_DIR = pathlib.Path(__file__).parent / 'corpus'
+
+def reference_sentences(title, text):
+  """The original sentence segmentation, which Segmenter's punkt backend must reproduce exactly."""
+  sent_detector = nltk.data.load('tokenizers/punkt/english.pickle')
+  paragraphs = webreader.newlines.split(text.strip())
+  return [
+    sent
+    for par in [title] + paragraphs
+    if par and webreader.alpha.search(par)
+    for sent in sent_detector.tokenize(par.strip())
+    if webreader.alpha.search(sent)
+  ]
+
+def segment_benchmark(corpus=None, backend='punkt', repeat=5, copies=200):
+  """
+  Segments `copies` of the corpus, joined into one text (book-length with the built-in corpus),
+  `repeat` times.
+  """
+  text = '\n'.join([pathlib.Path(corpus or CORPUS_DIR / 'segment.txt').read_text(encoding='utf8')] * copies)
+  segmenter = webreader.Segmenter(backend)
+  sents = 0
+  start = time.perf_counter()
+  for _ in range(repeat):
+    for _ in segmenter.sentences(None, text):
+      sents += 1
+  seconds = time.perf_counter() - start
+  sents_once = list(segmenter.sentences(None, text))
+  return dict(
+    benchmark='segment',
+    backend=backend,
+    corpus=str(corpus or 'built-in'),
+    copies=copies,
+    chars=len(text) * repeat,
+    sentences=sents,
+    seconds=seconds,
+    sentences_per_sec=sents / seconds,
+    matches_reference=sents_once == reference_sentences(None, text),
+    tts_requests=len(list(webreader.segments(sents_once))),
+    ssml_tts_requests=len(list(webreader.segments(sents_once, ssml=True))),
+  )
+
+class StageTimer(object):
+  """
+  Records the calls to and wall time spent in each pipeline stage, as seen by the stage histogram
+  while it's active.  Stages that run on several threads at once (like TTS requests) can add up to
+  more than the elapsed time.
+  """
+  def __enter__(self):
+    self.before = metrics.stage_seconds.snapshot()['values']
+    self.stages = {}
+    return self
+
+  def __exit__(self, *exc):
+    for (stage,), counts in metrics.stage_seconds.snapshot()['values'].items():
+      prev = self.before.get((stage,), [0] * len(counts))
+      calls = sum(counts[:-1]) - sum(prev[:-1])
+      if calls:
+        self.stages[stage] = dict(calls=calls, seconds=counts[-1] - prev[-1])
+
+def peak_rss_mb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+def setup_db(path):
+  """Points webreader at a SQLite database standing in for Postgres."""
+  engine = sa.create_engine('sqlite:///%s' % path)
+  webreader.Base.metadata.create_all(bind=engine)
+  webreader.db_session = scoped_session(sessionmaker(autocommit=True, autoflush=False, bind=engine))
+  return webreader.db_session
+
+def fixture_articles(site_url, n, book_repeat):
+  """
+  `n` articles cycling through the fixture pages (by URL) and the corpus text (by body), with every
+  tenth one a book-length text.
+  """
+  pages = sorted(f.name for f in (CORPUS_DIR / 'pages').glob('*.html'))
+  text = (CORPUS_DIR / 'segment.txt').read_text(encoding='utf8')
+  for i in range(n):
+    if i % 10 == 9:
+      yield dict(url=None, body='\n'.join([text] * book_repeat))
+    elif i % 2 == 0:
+      yield dict(url='%s/%s' % (site_url, pages[i // 2 % len(pages)]), body=None)
+    else:
+      yield dict(url=None, body=text)
+
+def converter_benchmark(tmp, articles=20, tts_latency=0.05, tts_error_rate=0, site_latency=0.02,
+                        concurrency=8, book_repeat=20):
+  ses = setup_db(tmp / 'bench.db')
+  webreader.mp3_store = webreader.Mp3Store(tmp / 'mp3s')
+  webreader.mp3_store.root.mkdir()
+  cfg = Namespace(to=None, base_url=None)
+  with fakes.FakeTTSServer(latency=tts_latency, error_rate=tts_error_rate) as tts, \
+       fakes.FakeSiteServer(CORPUS_DIR / 'pages', latency=site_latency) as site:
+    webreader.synthesizer = webreader.Synthesizer(
+      tts.url, concurrency, qps=0, tokens=webreader.TokenProvider(webreader.token_source('static:bench')))
+    webreader.page_cache = None
+    with ses.begin():
+      rows = [webreader.Article(created=datetime.now(), **a)
+              for a in fixture_articles(site.base_url, articles, book_repeat)]
+      ses.add_all(rows)
+      ses.flush()
+      webreader.put_many([webreader.task_for(row.id, row.url, row.body and len(row.body), 'interactive')
+                          for row in rows])
+    with StageTimer() as timer:
+      start = time.perf_counter()
+      while True:
+        with ses.begin():
+          task = webreader.claim_task(['interactive'], 'bench')
+          if task is None:
+            break
+          ses.flush()
+          ses.expunge(task)
+        with metrics.span('article'):
+          webreader.process_task(cfg, task)
+      seconds = time.perf_counter() - start
+    with ses.begin():
+      converted = ses.query(webreader.Article).filter(webreader.Article.converted != None).count()
+  return dict(
+    benchmark='converter',
+    articles=articles,
+    converted=converted,
+    seconds=seconds,
+    articles_per_min=articles / seconds * 60,
+    tts_requests=len(tts.requests),
+    tts_errors=tts.errors,
+    http=webreader.request_stats(),
+    stages=dict(timer.stages),
+    peak_rss_mb=peak_rss_mb(),
+  )
+
+def requests_per_sec(path, seconds, headers=None):
+  client = webreader.app.test_client()
+  n = 0
+  start = time.perf_counter()
+  while time.perf_counter() - start < seconds:
+    resp = client.get(path, headers=headers)
+    assert resp.status_code in (200, 206, 304), resp.status_code
+    resp.close()
+    n += 1
+  return dict(requests=n, requests_per_sec=n / (time.perf_counter() - start))
+
+def web_benchmark(seconds=2):
+  """Hits the Flask views of whatever DB and MP3 dir converter_benchmark set up."""
+  webreader.app.config['base_url'] = 'http://localhost:5000'
+  article_id = webreader.db_session.query(webreader.Article.id)\
+    .filter(webreader.Article.converted != None).order_by(webreader.Article.id).limit(1).scalar()
+  return dict(
+    benchmark='web',
+    feed=requests_per_sec('/feed', seconds),
+    mp3=requests_per_sec('/mp3/%s' % article_id, seconds),
+    mp3_range=requests_per_sec('/mp3/%s' % article_id, seconds, {'Range': 'bytes=0-65535'}),
+  )
+
+def run(articles=20, tts_latency=0.05, tts_error_rate=0, concurrency=8, book_repeat=20):
+  """Runs every benchmark in a scratch directory."""
+  with tempfile.TemporaryDirectory(prefix='webreader-bench') as tmp:
+    return dict(
+      version=swallow(lambda: importlib.metadata.version('webreader')),
+      python=sys.version.split()[0],
+      segment=segment_benchmark(),
+      converter=converter_benchmark(pathlib.Path(tmp), articles, tts_latency, tts_error_rate,
+                                    concurrency=concurrency, book_repeat=book_repeat),
+      web=web_benchmark(),
+    )
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-ins for external services, for exercising the converter without network access.
+
+Run a fake TTS server with e.g.:
+
+    python -m webreader.fakes --port 8099
+
+and point the converter at it with `--tts-url http://localhost:8099/v1/text:synthesize`.
+"""
+import base64
+import json
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from webreader import mpeg
+
+class FakeServer(object):
+  """Runs an HTTP server on localhost on a background thread."""
+  def __init__(self, handler, port=0):
+    self.httpd = ThreadingHTTPServer(('localhost', port), handler)
+    self.httpd.daemon_threads = True
+
+  @property
+  def base_url(self):
+    return 'http://localhost:%s' % self.httpd.server_address[1]
+
+  def start(self):
+    threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+class FakeTTSServer(FakeServer):
+  """
+  Minimal imitation of the `text:synthesize` endpoint.  Every request gets back silent 24kHz mono
+  MP3 frames, like Google's: `frames` of them, or by default about as many as it would take to
+  read the text aloud.  Each response is delayed by `latency` seconds (+/- 50% jitter), and a
+  fraction `error_rate` of requests fail with a 503.  With `tokens`, requests whose bearer token
+  isn't one of them fail with a 401.  Successful requests are recorded in `requests`, and the most
+  that were ever under way at once in `max_in_flight`.
+  """
+  def __init__(self, port=0, frames=None, latency=0, error_rate=0, tokens=None):
+    self.frames = frames
+    self.latency = latency
+    self.error_rate = error_rate
+    self.tokens = tokens
+    self.requests = []
+    self.errors = 0
+    self.unauthorized = 0
+    self.in_flight = self.max_in_flight = 0
+    self.lock = threading.Lock()
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_POST(self):
+        with server.lock:
+          server.in_flight += 1
+          server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+          self.respond()
+        finally:
+          with server.lock:
+            server.in_flight -= 1
+
+      def fail(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+      def respond(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if server.latency:
+          time.sleep(server.latency * random.uniform(0.5, 1.5))
+        token = self.headers.get('Authorization', '').partition('Bearer ')[2]
+        if server.tokens is not None and token not in server.tokens:
+          with server.lock:
+            server.unauthorized += 1
+          return self.fail(401)
+        if random.random() < server.error_rate:
+          with server.lock:
+            server.errors += 1
+          return self.fail(503)
+        with server.lock:
+          server.requests.append(body)
+        text = body['input'].get('text') or body['input'].get('ssml') or ''
+        # Roughly 15 characters of speech per second.
+        frames = server.frames or max(1, int(len(text) / 15 * 24000 / 576))
+        out = json.dumps(dict(audioContent=base64.b64encode(mpeg.silent_frame(24000, True) * frames).decode('ascii')))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out.encode('utf8'))
+
+      def log_message(self, format, *args):
+        pass
+
+    super().__init__(Handler, port)
+
+  @property
+  def url(self):
+    return '%s/v1/text:synthesize' % self.base_url
+
+class FakeSiteServer(FakeServer):
+  """Serves the files under `root` as web pages, each delayed by `latency` seconds."""
+  def __init__(self, root, port=0, latency=0):
+    class Handler(SimpleHTTPRequestHandler):
+      def do_GET(self):
+        if latency:
+          time.sleep(latency)
+        super().do_GET()
+
+      def log_message(self, format, *args):
+        pass
+
+    super().__init__(partial(Handler, directory=str(root)), port)
+
+def main():
+  p = ArgumentParser(description='Run a fake TTS server')
+  p.add_argument('-p', '--port', type=int, default=8099)
+  p.add_argument('--latency', type=float, default=0,
+                 help='Seconds to delay each response')
+  p.add_argument('--error-rate', type=float, default=0,
+                 help='Fraction of requests to fail with a 503')
+  cfg = p.parse_args()
+  server = FakeTTSServer(cfg.port, latency=cfg.latency, error_rate=cfg.error_rate)
+  print('serving fake TTS at %s' % server.url)
+  server.httpd.serve_forever()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+A small in-process metrics registry that renders the Prometheus text exposition format.
+
+Snapshots are plain dicts, so they can be shipped between processes (e.g. from converter workers
+to their parent) and merged.
+"""
+import collections
+import contextlib
+import os
+import pathlib
+import pickle
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metric(object):
+  kind = None
+
+  def __init__(self, name, help, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def key(self, labels):
+    return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+  def snapshot(self, clear=False):
+    with self.lock:
+      values, self.values = self.values, ({} if clear else self.values)
+      return dict(kind=self.kind, help=self.help, labelnames=self.labelnames,
+                  values={key: list(v) if isinstance(v, list) else v for key, v in values.items()})
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, amount=1, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+  kind = 'gauge'
+
+  def set(self, value, **labels):
+    with self.lock:
+      self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    super().__init__(name, help, labelnames)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, **labels):
+    key = self.key(labels)
+    with self.lock:
+      # Per-bucket (not cumulative) counts, then the +Inf bucket, then the sum.
+      counts = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+      counts[next((i for i, le in enumerate(self.buckets) if value <= le), len(self.buckets))] += 1
+      counts[-1] += value
+
+  def snapshot(self, clear=False):
+    snap = super().snapshot(clear)
+    snap['buckets'] = self.buckets
+    return snap
+
+class Registry(object):
+  def __init__(self):
+    self.metrics = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def register(self, metric):
+    with self.lock:
+      return self.metrics.setdefault(metric.name, metric)
+
+  def counter(self, name, help, labelnames=()):
+    return self.register(Counter(name, help, labelnames))
+
+  def gauge(self, name, help, labelnames=()):
+    return self.register(Gauge(name, help, labelnames))
+
+  def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return self.register(Histogram(name, help, labelnames, buckets))
+
+  def snapshot(self):
+    return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+  def drain(self):
+    """
+    Snapshots and resets every metric, for shipping increments to another process to merge.  Gauges
+    aren't meaningful as increments, so only drain registries of counters and histograms.
+    """
+    return {name: metric.snapshot(clear=True) for name, metric in list(self.metrics.items())}
+
+def merge(*snapshots):
+  """Adds up snapshots from several processes.  Gauges are summed too."""
+  merged = {}
+  for snap in snapshots:
+    for name, metric in snap.items():
+      into = merged.setdefault(name, dict(metric, values={}))
+      for key, value in metric['values'].items():
+        if key not in into['values']:
+          into['values'][key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+          into['values'][key] = [a + b for a, b in zip(into['values'][key], value)]
+        else:
+          into['values'][key] += value
+  return merged
+
+def publish(directory, snapshot, pid=None):
+  """
+  Saves a process's cumulative `snapshot` in `directory`, for processes that can't ship increments
+  to a parent (e.g. gunicorn workers) to read each other's with `gather`.  Gauges are left out, since
+  summing them across processes is meaningless.
+  """
+  path = pathlib.Path(directory) / ('%s.pickle' % (pid or os.getpid()))
+  tmp = path.with_name('.%s.tmp' % path.name)
+  tmp.write_bytes(pickle.dumps({name: metric for name, metric in snapshot.items() if metric['kind'] != 'gauge'}))
+  os.replace(tmp, path)
+
+def retire(directory, pid):
+  """Keeps the last snapshot published by a process that exited, so its counts are never lost."""
+  path = pathlib.Path(directory) / ('%s.pickle' % pid)
+  if path.exists():
+    os.replace(path, path.with_name('retired-%s-%s.pickle' % (pid, time.time_ns())))
+
+def gather(directory, exclude=None):
+  """Merges the snapshots published in `directory`, except that of process `exclude`."""
+  while True:
+    try:
+      return merge(*[pickle.loads(path.read_bytes()) for path in pathlib.Path(directory).glob('*.pickle')
+                     if path.name != '%s.pickle' % exclude])
+    except FileNotFoundError:
+      # One was retired while we were reading, so read them all again, under its new name.
+      continue
+
+def format_labels(labelnames, key, extra=()):
+  pairs = list(zip(labelnames, key)) + list(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join(
+    '%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+    for name, value in pairs)
+
+def render(snapshot):
+  lines = []
+  for name, metric in sorted(snapshot.items()):
+    lines.append('# HELP %s %s' % (name, metric['help']))
+    lines.append('# TYPE %s %s' % (name, metric['kind']))
+    for key, value in sorted(metric['values'].items()):
+      if metric['kind'] == 'histogram':
+        cumulative = 0
+        for le, count in zip(list(metric['buckets']) + ['+Inf'], value[:-1]):
+          cumulative += count
+          lines.append('%s_bucket%s %s' % (name, format_labels(metric['labelnames'], key, [('le', str(le))]), cumulative))
+        lines.append('%s_sum%s %s' % (name, format_labels(metric['labelnames'], key), value[-1]))
+        lines.append('%s_count%s %s' % (name, format_labels(metric['labelnames'], key), cumulative))
+      else:
+        lines.append('%s%s %s' % (name, format_labels(metric['labelnames'], key), value))
+  return '\n'.join(lines) + '\n'
+
+def serve(port, collect):
+  """Serves `render(collect())` at /metrics on a background thread."""
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path.split('?')[0] != '/metrics':
+        self.send_error(404)
+        return
+      out = render(collect()).encode('utf8')
+      self.send_response(200)
+      self.send_header('Content-Type', CONTENT_TYPE)
+      self.send_header('Content-Length', str(len(out)))
+      self.end_headers()
+      self.wfile.write(out)
+
+    def log_message(self, format, *args):
+      pass
+
+  httpd = ThreadingHTTPServer(('', port), Handler)
+  httpd.daemon_threads = True
+  threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+  return httpd
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+  'webreader_stage_seconds', 'Time spent in each stage of converting an article', ['stage'])
+
+class Timings(object):
+  """Total seconds per stage for the task currently being processed."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.stages = collections.Counter()
+
+  def add(self, stage, seconds):
+    with self.lock:
+      self.stages[stage] += seconds
+
+  def reset(self):
+    with self.lock:
+      self.stages = collections.Counter()
+
+  def snapshot(self):
+    with self.lock:
+      return {stage: round(seconds, 4) for stage, seconds in self.stages.items()}
+
+def reset_locks():
+  # A lock held by another thread at fork time would stay held forever in the child.
+  registry.lock = threading.Lock()
+  current.lock = threading.Lock()
+  for metric in registry.metrics.values():
+    metric.lock = threading.Lock()
+
+# Converter workers handle one article at a time, so a single process-wide record suffices (and,
+# unlike a thread-local one, also sees stages that run on the TTS thread pool).
+current = Timings()
+os.register_at_fork(after_in_child=reset_locks)
+
+@contextlib.contextmanager
+def span(stage):
+  """Times a stage, recording it in the stage histogram and the current task's timings."""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    stage_seconds.observe(elapsed, stage=stage)
+    current.add(stage, elapsed)
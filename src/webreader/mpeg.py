@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+Just enough MPEG audio (Layer III) frame parsing to concatenate MP3 streams without re-encoding.
+"""
+import functools
+import math
+import struct
+import subprocess as subp
+from collections import namedtuple
+
+# Indexed by [version][index]; versions are the raw header bits (0 = MPEG 2.5, 2 = MPEG 2, 3 = MPEG 1).
+BITRATES = {
+  3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+  2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+  0: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+SAMPLE_RATES = {
+  3: [44100, 48000, 32000],
+  2: [22050, 24000, 16000],
+  0: [11025, 12000, 8000],
+}
+
+class FrameHeader(namedtuple('FrameHeader', 'version bitrate sample_rate padding mono crc length')):
+  __slots__ = ()
+
+  @property
+  def samples(self):
+    return 1152 if self.version == 3 else 576
+
+  @property
+  def side_info_length(self):
+    return side_info_length(self.version, self.mono)
+
+def side_info_length(version, mono):
+  if version == 3:
+    return 17 if mono else 32
+  return 9 if mono else 17
+
+class FormatMismatch(Exception):
+  pass
+
+def parse_header(buf, pos=0):
+  """
+  :return: The Layer III frame header at `pos`, or None if there isn't a valid one there.
+  :rtype: FrameHeader
+  """
+  if len(buf) < pos + 4: return None
+  b0, b1, b2, b3 = buf[pos:pos + 4]
+  version = (b1 >> 3) & 3
+  if b0 != 0xff or (b1 & 0xe0) != 0xe0 or version == 1 or (b1 >> 1) & 3 != 1:
+    return None
+  bitrate_idx, sr_idx = b2 >> 4, (b2 >> 2) & 3
+  if bitrate_idx in (0, 15) or sr_idx == 3:
+    return None
+  bitrate = BITRATES[version][bitrate_idx] * 1000
+  sample_rate = SAMPLE_RATES[version][sr_idx]
+  padding = (b2 >> 1) & 1
+  length = (144 if version == 3 else 72) * bitrate // sample_rate + padding
+  return FrameHeader(version, bitrate, sample_rate, padding, b3 >> 6 == 3, not b1 & 1, length)
+
+def id3v2_length(buf):
+  if len(buf) < 10 or buf[:3] != b'ID3': return 0
+  size = 0
+  for b in buf[6:10]:
+    size = (size << 7) | (b & 0x7f)
+  return 10 + size + (10 if buf[5] & 0x10 else 0)
+
+def is_vbr_header(hdr, frame):
+  """Whether `frame` is a Xing/Info/VBRI metadata frame rather than audio."""
+  offset = 4 + (2 if hdr.crc else 0) + hdr.side_info_length
+  return bytes(frame[offset:offset + 4]) in (b'Xing', b'Info') or bytes(frame[36:40]) == b'VBRI'
+
+def frames(data):
+  """
+  Yields (header, frame) for each audio frame in an MP3 file's contents, skipping ID3 tags and any
+  leading Xing/Info/VBRI frame, and resynchronizing past junk between frames.
+  """
+  buf = memoryview(data)
+  end = len(buf)
+  if end >= 128 and buf[end - 128:end - 125] == b'TAG':
+    end -= 128
+  pos = id3v2_length(buf)
+  first = True
+  while pos + 4 <= end:
+    hdr = parse_header(buf, pos)
+    if hdr is None:
+      pos += 1
+      continue
+    if pos + hdr.length > end:
+      break
+    frame = buf[pos:pos + hdr.length]
+    pos += hdr.length
+    if first:
+      first = False
+      if is_vbr_header(hdr, frame):
+        continue
+    yield hdr, frame
+
+def duration(path):
+  """
+  The duration in seconds of an MP3 file, from its Xing header if it has one with a frame count
+  (which everything we write does), otherwise by counting frames.
+  """
+  with open(path, 'rb') as f:
+    head = f.read(64 * 1024)
+    buf = memoryview(head)
+    pos = id3v2_length(buf)
+    while pos + 4 <= len(buf) and parse_header(buf, pos) is None:
+      pos += 1
+    hdr = parse_header(buf, pos)
+    if hdr is not None:
+      offset = pos + 4 + (2 if hdr.crc else 0) + hdr.side_info_length
+      if bytes(buf[offset:offset + 4]) in (b'Xing', b'Info') and len(buf) >= offset + 12:
+        flags, nframes = struct.unpack('>II', buf[offset + 4:offset + 12])
+        if flags & 1:
+          return nframes * hdr.samples / hdr.sample_rate
+    data = head + f.read()
+  return sum(hdr.samples / hdr.sample_rate for hdr, frame in frames(data))
+
+def make_header(version, bitrate, sample_rate, mono, padding=0):
+  bitrate_idx = BITRATES[version].index(bitrate // 1000)
+  sr_idx = SAMPLE_RATES[version].index(sample_rate)
+  return bytes([
+    0xff,
+    0xe0 | (version << 3) | (1 << 1) | 1,
+    (bitrate_idx << 4) | (sr_idx << 2) | (padding << 1),
+    (3 if mono else 0) << 6,
+  ])
+
+def version_for(sample_rate):
+  return next(v for v, rates in SAMPLE_RATES.items() if sample_rate in rates)
+
+def empty_frame(sample_rate, mono, min_length):
+  """
+  The lowest-bitrate frame in this format that's at least `min_length` bytes, zeroed after the
+  header.  Zeroed side info means no Huffman data, so it decodes to silence.
+  """
+  version = version_for(sample_rate)
+  for kbps in BITRATES[version][1:]:
+    hdr = make_header(version, kbps * 1000, sample_rate, mono)
+    length = parse_header(hdr).length
+    if length >= min_length:
+      return bytearray(hdr + bytes(length - 4))
+  raise ValueError('no frame large enough for %s bytes' % min_length)
+
+@functools.lru_cache(maxsize=None)
+def silent_frame(sample_rate, mono):
+  return bytes(empty_frame(sample_rate, mono, 4 + side_info_length(version_for(sample_rate), mono)))
+
+@functools.lru_cache(maxsize=None)
+def silence(seconds, sample_rate=24000, mono=True):
+  frame = silent_frame(sample_rate, mono)
+  n = math.ceil(seconds * sample_rate / parse_header(frame).samples)
+  return frame * n
+
+def transcode(data, sample_rate, mono):
+  """Re-encodes an MP3 to the given format with ffmpeg, for inputs that can't be joined as-is."""
+  return subp.run(
+    ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'mp3', '-i', 'pipe:0',
+     '-ar', str(sample_rate), '-ac', '1' if mono else '2', '-acodec', 'libmp3lame', '-f', 'mp3', 'pipe:1'],
+    input=data, stdout=subp.PIPE, check=True,
+  ).stdout
+
+def reencode(src, dst, bitrate, sample_rate=24000, mono=True):
+  """Re-encodes the MP3 file `src` into `dst` at a constant `bitrate` (in bits/sec) with ffmpeg."""
+  subp.run(
+    ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'mp3', '-i', str(src),
+     '-ar', str(sample_rate), '-ac', '1' if mono else '2', '-acodec', 'libmp3lame',
+     '-b:a', str(bitrate), '-f', 'mp3', str(dst)],
+    check=True,
+  )
+
+class Mp3Joiner(object):
+  """
+  Streams the audio frames of several MP3s into a single seekable file `f`, all of which must
+  share one sample rate and channel layout.  The output starts with a Xing header (written as a
+  placeholder, then filled in by `close`) so players can work out the duration.
+
+  Pass a previous joiner's `state` as `resume` to continue appending to a file it was writing;
+  anything written after that state was taken is truncated.
+  """
+  XING_LENGTH = 4 + 4 + 4 + 4
+
+  def __init__(self, f, sample_rate=24000, mono=True, resume=None):
+    self.f = f
+    self.sample_rate = sample_rate
+    self.mono = mono
+    self.xing_offset = 4 + side_info_length(version_for(sample_rate), mono)
+    self.xing_frame = empty_frame(sample_rate, mono, self.xing_offset + self.XING_LENGTH)
+    if resume:
+      self.start, self.frames, self.bytes = resume
+      f.seek(self.start + len(self.xing_frame) + self.bytes)
+      f.truncate()
+    else:
+      self.start, self.frames, self.bytes = f.tell(), 0, 0
+      f.write(self.xing_frame)
+
+  @property
+  def state(self):
+    return [self.start, self.frames, self.bytes]
+
+  @property
+  def duration(self):
+    return self.frames * parse_header(self.xing_frame).samples / self.sample_rate
+
+  def append(self, data):
+    """
+    :raise FormatMismatch: If `data` isn't at our sample rate and channel layout; nothing is
+    written in that case.
+    """
+    out = []
+    for hdr, frame in frames(data):
+      if hdr.sample_rate != self.sample_rate or hdr.mono != self.mono:
+        raise FormatMismatch('expected %s Hz %s, got %s Hz %s' % (
+          self.sample_rate, 'mono' if self.mono else 'stereo',
+          hdr.sample_rate, 'mono' if hdr.mono else 'stereo'))
+      out.append(frame)
+    for frame in out:
+      self.f.write(frame)
+      self.bytes += len(frame)
+    self.frames += len(out)
+
+  def append_silence(self, seconds):
+    self.append(silence(seconds, self.sample_rate, self.mono))
+
+  def close(self):
+    # Flags 0x3: frame count and byte count present.
+    self.xing_frame[self.xing_offset:self.xing_offset + self.XING_LENGTH] = struct.pack(
+      '>4sIII', b'Xing', 3, self.frames, self.bytes + len(self.xing_frame))
+    end = self.f.tell()
+    self.f.seek(self.start)
+    self.f.write(self.xing_frame)
+    self.f.seek(end)
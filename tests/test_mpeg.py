@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Checks that MP3s are joined, resumed and measured frame for frame, on synthetic frames."""
+import struct
+
+import pytest
+
+from webreader import mpeg
+
+def audio(n, fill, sample_rate=24000, mono=True, kbps=32):
+  """`n` frames whose payload bytes are all `fill`, so each call's frames can be told apart."""
+  hdr = mpeg.make_header(mpeg.version_for(sample_rate), kbps * 1000, sample_rate, mono)
+  return (hdr + bytes([fill]) * (mpeg.parse_header(hdr).length - 4)) * n
+
+def payloads(data):
+  return [bytes(frame) for hdr, frame in mpeg.frames(data)]
+
+def info_frame(nframes, sample_rate=24000, mono=True):
+  offset = 4 + mpeg.side_info_length(mpeg.version_for(sample_rate), mono)
+  frame = mpeg.empty_frame(sample_rate, mono, offset + 12)
+  frame[offset:offset + 12] = struct.pack('>4sII', b'Info', 1, nframes)
+  return bytes(frame)
+
+def id3v2(body):
+  size = len(body)
+  return b'ID3\x04\x00\x00' + bytes((size >> shift) & 0x7f for shift in (21, 14, 7, 0)) + body
+
+def id3v1():
+  # Hides a whole valid frame in the tag, which must not be mistaken for audio.
+  fake = mpeg.make_header(0, 8000, 8000, True)
+  fake += bytes(mpeg.parse_header(fake).length - 4)
+  return (b'TAG' + fake).ljust(128, b'\0')
+
+def test_joined_output_round_trips(tmp_path):
+  path = tmp_path / 'out.mp3'
+  parts = [audio(3, 1), mpeg.silence(0.1), audio(2, 2)]
+  with open(path, 'w+b') as f:
+    joiner = mpeg.Mp3Joiner(f)
+    for part in parts:
+      joiner.append(part)
+    joiner.close()
+  data = path.read_bytes()
+  assert payloads(data) == [frame for part in parts for frame in payloads(part)]
+  assert joiner.frames == len(payloads(data))
+  assert mpeg.duration(path) == pytest.approx(joiner.duration)
+  assert joiner.duration == pytest.approx(joiner.frames * 576 / 24000)
+
+def test_tags_and_info_frame_skipped(tmp_path):
+  body = audio(3, 1)
+  # The ID3v2 tag holds a valid frame header too.
+  data = id3v2(audio(1, 9)) + info_frame(10) + body + id3v1()
+  assert payloads(data) == payloads(body)
+  path = tmp_path / 'tagged.mp3'
+  path.write_bytes(data)
+  # The Info frame's count wins over the frames actually there.
+  assert mpeg.duration(path) == pytest.approx(10 * 576 / 24000)
+  path.write_bytes(id3v2(b'') + body + id3v1())
+  assert mpeg.duration(path) == pytest.approx(3 * 576 / 24000)
+
+@pytest.mark.parametrize('other', [dict(sample_rate=22050), dict(mono=False)])
+def test_format_mismatch_writes_nothing(tmp_path, other):
+  with open(tmp_path / 'out.mp3', 'w+b') as f:
+    joiner = mpeg.Mp3Joiner(f)
+    joiner.append(audio(2, 1))
+    state, size = joiner.state, f.tell()
+    # Frames that do match, ahead of the ones that don't, aren't written either.
+    with pytest.raises(mpeg.FormatMismatch):
+      joiner.append(audio(2, 2) + audio(1, 3, **other))
+    assert (joiner.state, f.tell()) == (state, size)
+
+def test_resume_truncates_after_state(tmp_path):
+  path = tmp_path / 'out.mp3'
+  with open(path, 'w+b') as f:
+    joiner = mpeg.Mp3Joiner(f)
+    joiner.append(audio(3, 1))
+    state = joiner.state
+    # Written after the state was saved, then lost in a crash before close.
+    joiner.append(audio(4, 2))
+  with open(path, 'r+b') as f:
+    joiner = mpeg.Mp3Joiner(f, resume=state)
+    joiner.append(audio(2, 3))
+    joiner.close()
+  data = path.read_bytes()
+  assert payloads(data) == payloads(audio(3, 1)) + payloads(audio(2, 3))
+  assert len(data) == len(joiner.xing_frame) + len(audio(3, 1)) + len(audio(2, 3))
+  assert mpeg.duration(path) == pytest.approx(5 * 576 / 24000)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+"""Checks which pages fetch_page accepts, against a fake site, and what the page cache prunes."""
+import os
+
+import pytest
+
+import webreader
+from webreader import fakes
+
+@pytest.fixture
+def site(tmp_path):
+  (tmp_path / 'page.html').write_bytes(b'<html><body><p>Hello.</p></body></html>')
+  (tmp_path / 'empty.txt').write_bytes(b'')
+  (tmp_path / 'empty.png').write_bytes(b'')
+  (tmp_path / 'image.png').write_bytes(b'<html>not really</html>')
+  with fakes.FakeSiteServer(tmp_path) as server:
+    yield server.base_url
+
+def test_html_and_text_accepted(site):
+  resp, mimetype, charset, data = webreader.fetch_page(site + '/page.html', {})
+  assert (mimetype, data) == ('text/html', b'<html><body><p>Hello.</p></body></html>')
+  assert webreader.fetch_page(site + '/empty.txt', {})[1:] == ('text/plain', None, b'')
+
+@pytest.mark.parametrize('name', ['empty.png', 'image.png'])
+def test_declared_type_rejected_whatever_the_body(site, name):
+  with pytest.raises(webreader.PageRejected, match='image/png'):
+    webreader.fetch_page('%s/%s' % (site, name), {})
+
+def test_cache_prune_keeps_lock_files(tmp_path):
+  cache = webreader.PageCache(tmp_path, max_age=60)
+  loaded = dict(title='A title', text='Hello.', etag=None, last_modified=None, digest='x')
+  assert cache.get('http://a.example/', lambda headers, digest: loaded) == ('A title', 'Hello.')
+  path = cache.path('http://a.example/')
+  for f in path.parent.iterdir():
+    os.utime(f, (0, 0))
+  cache.prune()
+  assert sorted(f.name for f in path.parent.iterdir()) == [path.with_suffix('.lock').name]
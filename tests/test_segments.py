@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Checks sentence segmentation, and that sentences are packed into TTS requests that fit, as few as
+possible, losing no text."""
+import html
+import random
+import re
+
+import pytest
+
+import webreader
+
+def random_sentences(rng, n):
+  """Sentences of all lengths, some far too long for one request, with multibyte text and markup."""
+  words = ['a', 'the', 'fish', 'naïve', 'café', '日本語', '😀', 'A&B', '<b>', 'x>y', '"q"', 'it\'s',
+           'end.', 'so,', 'then;', 'wait:', '--', '—', '...', 'x' * 60]
+  for _ in range(n):
+    length = rng.choice([1, 5, 30, 300, 3000])
+    yield ' '.join(rng.choice(words) for _ in range(rng.randint(1, length)))
+
+def cases(trials=100, seed=0):
+  rng = random.Random(seed)
+  for _ in range(trials):
+    yield list(random_sentences(rng, rng.randint(1, 20))), rng.choice([60, 200, 1000, 5000])
+
+def first_piece(seg, ssml):
+  return re.search(r'<s>.*?</s>', seg).group() if ssml else '.\n' + seg.split('.\n')[0]
+
+def spoken(segs, ssml):
+  if ssml:
+    return ''.join(html.unescape(re.sub(r'<[^>]*>', '', seg)) for seg in segs)
+  return ''.join(seg.replace('.\n', '') for seg in segs)
+
+@pytest.mark.parametrize('ssml', [False, True])
+def test_segments_fit(ssml):
+  for sents, maxbytes in cases():
+    for seg in webreader.segments(sents, maxbytes, ssml):
+      assert webreader.utf8_len(seg) <= maxbytes, (maxbytes, seg)
+
+@pytest.mark.parametrize('ssml', [False, True])
+def test_segments_are_full(ssml):
+  # Greedy packing is only optimal if each request was closed because the next piece didn't fit.
+  for sents, maxbytes in cases():
+    segs = list(webreader.segments(sents, maxbytes, ssml))
+    for seg, nxt in zip(segs, segs[1:]):
+      assert webreader.utf8_len(seg + first_piece(nxt, ssml)) > maxbytes, (maxbytes, seg, nxt)
+
+@pytest.mark.parametrize('ssml', [False, True])
+def test_segments_keep_text(ssml):
+  for sents, maxbytes in cases():
+    segs = webreader.segments(sents, maxbytes, ssml)
+    assert re.sub(r'\s+', '', spoken(segs, ssml)) == re.sub(r'\s+', '', ''.join(sents))
+
+@pytest.mark.parametrize('batch_size', [1, 3, 256])
+def test_punkt_matches_reference(batch_size):
+  from webreader import bench
+  text = (bench.CORPUS_DIR / 'segment.txt').read_text(encoding='utf8')
+  segmenter = webreader.Segmenter('punkt', batch_size)
+  assert list(segmenter.sentences('A title.', text)) == bench.reference_sentences('A title.', text)
+
+@pytest.mark.parametrize('maxbytes', [0, 20, 40, 44])
+def test_budget_too_small_for_markup(maxbytes):
+  # The SSML wrapping alone takes 43 bytes (and an escaped & another 5), so none of these fit.
+  with pytest.raises(ValueError):
+    list(webreader.segments(['&&&&&&&&&&'], maxbytes, ssml=True))
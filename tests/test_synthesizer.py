@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""Checks the Synthesizer against a fake TTS server: ordering, token refresh and how far it reads ahead."""
+import random
+
+import pytest
+import requests
+
+import webreader
+from webreader import fakes, mpeg
+
+def synthesizer(tts, concurrency=8, source=webreader.token_source('static:x')):
+  return webreader.Synthesizer(tts.url, concurrency, None, None, webreader.TokenProvider(source))
+
+def expected_audio(seg):
+  # As much silence as the fake server makes for text this long.
+  return mpeg.silent_frame(24000, True) * max(1, int(len(seg) / 15 * 24000 / 576))
+
+def test_output_in_order_under_concurrency():
+  # Segments of distinct lengths get distinct amounts of audio, so they can be told apart.
+  segs = ['x' * 15 * n for n in range(1, 41)]
+  random.Random(0).shuffle(segs)
+  with fakes.FakeTTSServer(latency=0.05) as tts:
+    out = list(synthesizer(tts).synthesize_stream(segs))
+  assert [len(audio) for audio in out] == [len(expected_audio(seg)) for seg in segs]
+  assert tts.max_in_flight > 1
+
+def test_rejected_token_refetched_once():
+  tokens = iter(['stale', 'fresh'])
+  with fakes.FakeTTSServer(tokens={'fresh'}) as tts:
+    audio = synthesizer(tts, source=lambda: (next(tokens), float('inf'))).synthesize('Hello there.')
+  assert audio == expected_audio('Hello there.')
+  assert (tts.unauthorized, len(tts.requests)) == (1, 1)
+
+def test_rejected_token_not_retried_twice():
+  fetched = []
+  def source():
+    fetched.append(1)
+    return 'stale', float('inf')
+  with fakes.FakeTTSServer(tokens={'fresh'}) as tts:
+    with pytest.raises(requests.HTTPError) as ex:
+      synthesizer(tts, source=source).synthesize('Hello there.')
+  assert ex.value.response.status_code == 401
+  assert (tts.unauthorized, len(fetched)) == (2, 2)
+
+def test_reads_ahead_at_most_window():
+  pulled = []
+  def segs():
+    for n in range(1, 101):
+      pulled.append(n)
+      yield 'x' * 15 * n
+  with fakes.FakeTTSServer(latency=0.02) as tts:
+    synth = synthesizer(tts, concurrency=4)
+    # How many segments had been pulled (so submitted) but not yet handed back, each time one was.
+    ahead = [len(pulled) - consumed for consumed, audio in enumerate(synth.synthesize_stream(segs()))]
+  assert max(ahead) == synth.window
+  assert tts.max_in_flight <= synth.concurrency
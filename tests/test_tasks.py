@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Checks the order converters take queued tasks in, and their leases, on SQLite standing in for Postgres."""
+from datetime import timedelta
+
+import pytest
+
+import webreader
+from webreader import bench
+
+@pytest.fixture(autouse=True)
+def db(tmp_path):
+  return bench.setup_db(tmp_path / 'db')
+
+def enqueue(*tasks):
+  with webreader.db_session.begin():
+    webreader.put_many(list(tasks))
+
+def claim_all(lanes=tuple(webreader.LANES)):
+  """The article IDs of the tasks in `lanes`, in the order they're claimed."""
+  claimed = []
+  while True:
+    with webreader.db_session.begin():
+      task = webreader.claim_task(list(lanes), 'test:1')
+      if task is None:
+        return claimed
+      claimed.append(task.article_id)
+
+def test_lanes_in_priority_order():
+  enqueue(webreader.task_for(1, None, 100, 'bulk'))
+  enqueue(webreader.task_for(2, None, 100, 'enhanced', enhanced=True))
+  enqueue(webreader.task_for(3, None, 100, 'interactive'))
+  assert claim_all() == [3, 2, 1]
+
+def test_lanes_left_out_are_skipped():
+  enqueue(webreader.task_for(1, None, 100, 'enhanced', enhanced=True),
+          webreader.task_for(2, None, 100, 'bulk'))
+  assert claim_all(['interactive', 'bulk']) == [2]
+  assert claim_all() == [1]
+
+def test_sources_take_turns():
+  enqueue(*[webreader.task_for(id, 'http://a.example/%s' % id, 100, 'bulk') for id in (1, 2, 3)])
+  enqueue(*[webreader.task_for(id, 'http://b.example/%s' % id, 100, 'bulk') for id in (4, 5)])
+  assert claim_all() == [1, 4, 2, 5, 3]
+
+def test_new_source_does_not_wait_behind_backlog():
+  enqueue(*[webreader.task_for(id, 'http://a.example/%s' % id, 100, 'bulk') for id in (1, 2, 3)])
+  with webreader.db_session.begin():
+    assert webreader.claim_task(['bulk'], 'test:1').article_id == 1
+  # Its turn is the lane's current one, alongside a's next, rather than after all of a's.
+  enqueue(webreader.task_for(4, 'http://b.example/4', 100, 'bulk'))
+  assert claim_all() == [2, 4, 3]
+
+def test_short_before_long():
+  enqueue(webreader.task_for(1, 'http://a.example/1', 360000, 'bulk'))
+  enqueue(webreader.task_for(2, 'http://a.example/2', 100, 'bulk'))
+  assert claim_all() == [2, 1]
+
+def test_long_not_passed_over_beyond_aging_bound():
+  long = webreader.task_for(1, 'http://a.example/1', 360000, 'bulk')
+  # A book's worth of aging (an hour) has passed, plus a bit.
+  long['enqueued_at'] -= timedelta(hours=1, minutes=1)
+  long['due_at'] -= timedelta(hours=1, minutes=1)
+  enqueue(long)
+  enqueue(webreader.task_for(2, 'http://a.example/2', 100, 'bulk'))
+  assert claim_all() == [1, 2]
+
+def expire_leases():
+  """Runs out every lease, then re-queues the tasks as a converter would.  Returns the dead ones."""
+  with webreader.db_session.begin():
+    webreader.db_session.query(webreader.Task).update(
+      dict(lease_until=webreader.db_now(-1)), synchronize_session=False)
+    return webreader.release_leases(webreader.Task.lease_until < webreader.db_now(), 'lease expired')
+
+def task_state(task_id):
+  with webreader.db_session.begin():
+    return tuple(webreader.db_session.query(
+      webreader.Task.state, webreader.Task.claimed_by, webreader.Task.attempts, webreader.Task.last_error)
+      .filter(webreader.Task.id == task_id).one())
+
+def claim(owner):
+  with webreader.db_session.begin():
+    task = webreader.claim_task(list(webreader.LANES), owner)
+    return task and task.id
+
+def test_live_leases_are_kept():
+  enqueue(webreader.task_for(1, None, 100, 'bulk'))
+  task_id = claim('a:1')
+  with webreader.db_session.begin():
+    assert webreader.release_leases(webreader.Task.lease_until < webreader.db_now(), 'lease expired') == []
+  assert task_state(task_id)[:2] == ('leased', 'a:1')
+
+def test_expired_leases_requeued_until_attempts_run_out(monkeypatch):
+  monkeypatch.setattr(webreader, 'max_attempts', 2)
+  enqueue(webreader.task_for(1, None, 100, 'bulk'))
+  task_id = claim('a:1')
+  assert expire_leases() == []
+  assert task_state(task_id) == ('pending', None, 1, 'lease expired')
+  assert claim('b:2') == task_id
+  assert [task.id for task in expire_leases()] == [task_id]
+  assert task_state(task_id) == ('dead', None, 2, 'lease expired')
+  assert claim('c:3') is None
+
+def test_crashed_converter_released():
+  enqueue(webreader.task_for(1, None, 100, 'bulk'), webreader.task_for(2, None, 100, 'bulk'))
+  first, second = claim('a:1'), claim('b:2')
+  with webreader.db_session.begin():
+    webreader.release_leases(webreader.Task.claimed_by == 'a:1', 'converter worker got exit code -9')
+  assert task_state(first) == ('pending', None, 1, 'converter worker got exit code -9')
+  assert task_state(second)[:2] == ('leased', 'b:2')
+
+def test_finish_after_losing_lease():
+  enqueue(webreader.task_for(1, None, 100, 'bulk'))
+  task_id = claim('a:1')
+  expire_leases()
+  assert claim('b:2') == task_id
+  # The old owner can neither renew nor finish the task; only the new one can.
+  assert not webreader.renew_lease(task_id, 'a:1')
+  with webreader.db_session.begin():
+    webreader.finish_task(task_id, 'a:1', 'too late')
+  assert task_state(task_id)[:2] == ('leased', 'b:2')
+  assert webreader.renew_lease(task_id, 'b:2')
+  with webreader.db_session.begin():
+    webreader.finish_task(task_id, 'b:2')
+  assert task_state(task_id) == ('done', 'b:2', 2, None)